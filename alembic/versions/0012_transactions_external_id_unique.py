@@ -0,0 +1,55 @@
+"""unique index on transactions.external_payment_id
+
+Revision ID: 0012_transactions_external_id_unique
+Revises: 0011_transactions_charge_id_unique
+Create Date: 2026-10-17 18:00:00.000000
+"""
+
+from __future__ import annotations
+
+from alembic import op
+import sqlalchemy as sa
+
+from transkribator_modules.db.migration_helpers import fail_on_duplicates, find_index
+
+
+# revision identifiers, used by Alembic.
+revision = "0012_transactions_external_id_unique"
+down_revision = "0011_transactions_charge_id_unique"
+branch_labels = None
+depends_on = None
+
+TABLE = "transactions"
+INDEX_NAME = "ix_transactions_external_payment_id"
+COLUMN = "external_payment_id"
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+
+    if not inspector.has_table(TABLE):
+        return
+    current = find_index(inspector, TABLE, INDEX_NAME)
+    if current is not None and current.get("unique"):
+        return
+
+    # Дубликаты не чистятся автоматически: миграция остановится и перечислит их
+    fail_on_duplicates(bind, TABLE, COLUMN, INDEX_NAME)
+    # 0001 создал неуникальный индекс с тем же именем — заменяем его
+    if current is not None:
+        op.drop_index(INDEX_NAME, table_name=TABLE)
+    op.create_index(INDEX_NAME, TABLE, [COLUMN], unique=True)
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+
+    if not inspector.has_table(TABLE):
+        return
+    current = find_index(inspector, TABLE, INDEX_NAME)
+    if current is not None and current.get("unique"):
+        op.drop_index(INDEX_NAME, table_name=TABLE)
+        # Возвращаем неуникальный индекс из 0001
+        op.create_index(INDEX_NAME, TABLE, [COLUMN], unique=False)
@@ -1,3 +1,5 @@
+import asyncio
+
 from fastapi import APIRouter, Depends, HTTPException
 from typing import Dict, Any, List
 from core_api.api.v1.dependencies import verify_api_key
@@ -56,9 +58,11 @@ async def create_invoice(payload: Dict[str, Any], api_key: str = Depends(verify_
         if price <= 0:
             raise HTTPException(status_code=400, detail="Plan has no rub price")
         try:
-            from transkribator_modules.payments.yukassa import YukassaPaymentService
-            ys = YukassaPaymentService()
-            payment_info = ys.create_payment(
+            from transkribator_modules.payments.yukassa import get_yukassa_service
+            ys = get_yukassa_service()
+            # SDK ЮКассы синхронный: HTTP-запрос выполняем в пуле потоков, не на event loop
+            payment_info = await asyncio.to_thread(
+                ys.create_payment,
                 user_id=telegram_id,
                 plan_type=plan_id,
                 amount=price,
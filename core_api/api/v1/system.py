@@ -23,6 +23,17 @@ from transkribator_modules.api.miniapp import get_db
 from transkribator_modules.db.database import UserService
 from transkribator_modules.db.models import User
 import json
+from functools import lru_cache
+
+
+@lru_cache(maxsize=64)
+def _parse_features(raw: str) -> tuple:
+    """Разбирает JSON-список фич тарифа; изменённая строка в БД даёт новый ключ кэша."""
+    try:
+        parsed = json.loads(raw)
+    except Exception:
+        return (raw,)
+    return tuple(parsed) if isinstance(parsed, list) else (raw,)
 
 # Этот роутер будет монтироваться по префиксу /api/v1/system
 router = APIRouter()
@@ -65,18 +76,13 @@ async def health_check():
 @router.get("/plans", response_model=List[PlanInfo], tags=["Billing"])
 async def get_plans_endpoint():
     """Получить список доступных тарифных планов (Перенесено из api_server.py)"""
-    from transkribator_modules.db.repository.users import get_plans  # Временный импорт
+    from transkribator_modules.db.database import get_plans  # Временный импорт
     
     plans = get_plans()
     result = []
 
     for plan in plans:
-        features = []
-        if plan.features:
-            try:
-                features = json.loads(plan.features)
-            except:
-                features = [plan.features]
+        features = list(_parse_features(plan.features)) if plan.features else []
                 
         result.append(PlanInfo(
             name=plan.name,
@@ -0,0 +1,40 @@
+import os
+import tempfile
+
+# Ensure models select JSON vs JSONB correctly for tests
+os.environ["DATABASE_URL"] = os.environ.get("DATABASE_URL", "sqlite://")
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from transkribator_modules.db import database as db_module
+from transkribator_modules.db.models import Base, Plan
+
+
+@pytest.fixture
+def sqlite_session(monkeypatch):
+    """Temporary SQLite database behind the project's SessionLocal.
+
+    Modules that imported SessionLocal directly patch their own name with the
+    returned sessionmaker. A ``pro`` plan is seeded for upgrade paths.
+    """
+    fd, path = tempfile.mkstemp(suffix="_tests.sqlite")
+    os.close(fd)
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    monkeypatch.setattr(db_module, "SessionLocal", Session)
+
+    with Session() as session:
+        session.add(Plan(name="pro", display_name="PRO", is_active=True))
+        session.commit()
+
+    yield Session
+
+    Base.metadata.drop_all(engine)
+    engine.dispose()
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
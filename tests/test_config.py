@@ -0,0 +1,132 @@
+"""Tests for environment parsing and helpers in transkribator_modules.config."""
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from transkribator_modules import config
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+
+@pytest.fixture
+def env(monkeypatch):
+    snapshot = {}
+    monkeypatch.setattr(config, "_ENV", snapshot)
+    return snapshot
+
+
+def test_env_reads_the_import_time_snapshot(env, monkeypatch):
+    env["TRANSKRIBATOR_TEST_VALUE"] = "snapshot"
+    monkeypatch.setenv("TRANSKRIBATOR_TEST_VALUE", "live")
+
+    assert config._env("TRANSKRIBATOR_TEST_VALUE") == "snapshot"
+    assert config._env("TRANSKRIBATOR_TEST_MISSING") is None
+    assert config._env("TRANSKRIBATOR_TEST_MISSING", "fallback") == "fallback"
+
+
+@pytest.mark.parametrize("raw", ["1", "true", "TRUE", "yes", "Yes"])
+def test_bool_accepts_truthy_values(env, raw):
+    env["FLAG"] = raw
+    assert config._bool("FLAG") is True
+
+
+@pytest.mark.parametrize("raw", ["0", "false", "no", "off", "", "y"])
+def test_bool_rejects_everything_else(env, raw):
+    env["FLAG"] = raw
+    assert config._bool("FLAG") is False
+
+
+def test_bool_uses_the_default_when_unset(env):
+    assert config._bool("FLAG") is False
+    assert config._bool("FLAG", "true") is True
+
+
+def test_ensure_dir_creates_missing_directories_once(tmp_path, monkeypatch):
+    target = tmp_path / "a" / "b"
+    config._ensure_dir.cache_clear()
+
+    assert config._ensure_dir(target) == target
+    assert target.is_dir()
+
+    # Later calls for the same path are served from the cache without touching the filesystem
+    monkeypatch.setattr(type(target), "is_dir", lambda self: pytest.fail("stat repeated"))
+    assert config._ensure_dir(target) == target
+    assert config._ensure_dir.cache_info().hits == 1
+
+
+def test_ensure_dir_accepts_an_existing_directory(tmp_path):
+    config._ensure_dir.cache_clear()
+    assert config._ensure_dir(tmp_path) == tmp_path
+
+
+def _import_config(code, cwd, **extra_env):
+    """Import config in a fresh interpreter; module-level setup runs once per process.
+
+    The interpreter starts in ``cwd`` so that a local ``./data/bot.log`` stays out of the repo.
+    """
+    env = {k: v for k, v in os.environ.items() if k != "BOT_HTTP_POOL_SIZE"}
+    env.update(REQUIRE_BOT_TOKEN="false", PYTHONPATH=str(REPO_ROOT), **extra_env)
+    return subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+
+
+@pytest.mark.parametrize("extra_env, expected", [({}, "32"), ({"BOT_HTTP_POOL_SIZE": "7"}, "7")])
+def test_bot_http_pool_size_default_and_override(tmp_path, extra_env, expected):
+    result = _import_config(
+        "from transkribator_modules import config; print(config.BOT_HTTP_POOL_SIZE)",
+        tmp_path,
+        **extra_env,
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip().splitlines()[-1] == expected
+
+
+def test_logging_setup_installs_a_single_queue_handler(tmp_path):
+    result = _import_config(
+        "import logging\n"
+        "from logging.handlers import QueueHandler\n"
+        "from transkribator_modules import config\n"
+        "root = logging.getLogger().handlers\n"
+        "print(len(root), isinstance(root[0], QueueHandler))\n"
+        "print(sorted(type(h).__name__ for h in config._log_listener.handlers))\n",
+        tmp_path,
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.splitlines()[-2:] == ["1 True", "['FileHandler', 'StreamHandler']"]
+
+
+def test_logging_setup_keeps_preconfigured_root_handlers(tmp_path):
+    result = _import_config(
+        "import logging\n"
+        "handler = logging.NullHandler()\n"
+        "logging.getLogger().addHandler(handler)\n"
+        "from transkribator_modules import config\n"
+        "print(logging.getLogger().handlers == [handler], hasattr(config, '_log_listener'))\n",
+        tmp_path,
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.splitlines()[-1] == "True False"
+
+
+def test_log_listener_flushes_queued_records_at_exit(tmp_path):
+    # No explicit stop: the atexit hook must drain the queue before the process ends
+    result = _import_config(
+        "from transkribator_modules import config\n"
+        "config.logger.info('listener-exit-marker')\n",
+        tmp_path,
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert "transkribator_modules.config - INFO - listener-exit-marker" in result.stderr
@@ -0,0 +1,56 @@
+"""Tests for the shared unique-index checks used by Alembic migrations."""
+import pytest
+import sqlalchemy as sa
+
+from transkribator_modules.db import migration_helpers
+
+
+@pytest.fixture
+def connection():
+    engine = sa.create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(sa.text("CREATE TABLE transactions (id INTEGER PRIMARY KEY, external_payment_id VARCHAR)"))
+        conn.execute(sa.text("CREATE INDEX ix_ext ON transactions (external_payment_id)"))
+        yield conn
+    engine.dispose()
+
+
+def _insert(conn, *values):
+    for value in values:
+        conn.execute(sa.text("INSERT INTO transactions (external_payment_id) VALUES (:v)"), {"v": value})
+
+
+def test_find_index(connection):
+    inspector = sa.inspect(connection)
+
+    assert migration_helpers.find_index(inspector, "transactions", "ix_ext")["unique"] == 0
+    assert migration_helpers.find_index(inspector, "transactions", "ix_missing") is None
+
+
+def test_duplicates_check_ignores_nulls(connection):
+    _insert(connection, "a", "b", None, None)
+
+    migration_helpers.fail_on_duplicates(connection, "transactions", "external_payment_id", "ix_ext")
+
+
+def test_duplicates_error_names_the_column_and_the_fix(connection):
+    _insert(connection, "a", "b", "a", "a")
+
+    with pytest.raises(RuntimeError) as excinfo:
+        migration_helpers.fail_on_duplicates(connection, "transactions", "external_payment_id", "ix_ext")
+
+    message = str(excinfo.value)
+    assert "transactions.external_payment_id" in message
+    assert "external_payment_id='a': 3 строк (id 1..4)" in message
+    assert "UPDATE transactions SET external_payment_id = NULL" in message
+    assert "alembic upgrade head" in message
+    # The check only reports; nothing is modified
+    assert connection.execute(sa.text("SELECT COUNT(*) FROM transactions")).scalar() == 4
+
+
+def test_duplicates_listing_is_truncated(connection, monkeypatch):
+    monkeypatch.setattr(migration_helpers, "MAX_LISTED_DUPLICATES", 2)
+    _insert(connection, *"aabbccdd")
+
+    with pytest.raises(RuntimeError, match=r"\(4 шт\.\)[\s\S]*и ещё 2"):
+        migration_helpers.fail_on_duplicates(connection, "transactions", "external_payment_id", "ix_ext")
@@ -0,0 +1,145 @@
+"""Tests for routing payment callback_data to the payment handlers."""
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from transkribator_modules.bot import callbacks, payments
+
+
+@pytest.fixture
+def handlers(monkeypatch):
+    mocks = {
+        "initiate_payment": AsyncMock(),
+        "initiate_yukassa_payment": AsyncMock(),
+        "show_payment_plans": AsyncMock(),
+        "_stay_basic": AsyncMock(),
+    }
+    for name, mock in mocks.items():
+        monkeypatch.setattr(payments, name, mock)
+    monkeypatch.setattr(payments, "log_step", MagicMock())
+    # The table captures handler objects at import time; rebuild it around the mocks
+    monkeypatch.setattr(payments, "_CALLBACK_HANDLERS", payments._build_callback_handlers())
+    return mocks
+
+
+def _callback_update(data):
+    update = MagicMock()
+    update.callback_query.data = data
+    update.callback_query.edit_message_text = AsyncMock()
+    return update
+
+
+async def _route(data):
+    update = _callback_update(data)
+    context = MagicMock()
+    await payments.handle_payment_callback(update, context)
+    return update, context
+
+
+@pytest.mark.parametrize(
+    "data, handler, plan_id",
+    [
+        ("buy_plan_pro_stars", "initiate_payment", "pro"),
+        ("buy_plan_pro_yukassa", "initiate_yukassa_payment", "pro"),
+        ("buy_plan_unlimited_stars", "initiate_payment", "unlimited"),
+        ("buy_plan_unlimited_year_yukassa", "initiate_yukassa_payment", "unlimited_year"),
+        # Legacy buttons without a method suffix pay with Stars
+        ("buy_plan_pro", "initiate_payment", "pro"),
+    ],
+)
+async def test_known_buy_callbacks_use_the_dispatch_table(handlers, data, handler, plan_id):
+    assert data in payments._CALLBACK_HANDLERS
+
+    update, context = await _route(data)
+
+    handlers[handler].assert_awaited_once_with(update, context, plan_id)
+
+
+@pytest.mark.parametrize("data, handler", [
+    ("show_payment_plans", "show_payment_plans"),
+    ("stay_basic", "_stay_basic"),
+])
+async def test_menu_callbacks_are_called_without_plan(handlers, data, handler):
+    update, context = await _route(data)
+
+    handlers[handler].assert_awaited_once_with(update, context)
+
+
+async def test_unknown_callback_is_reported(handlers):
+    update, _ = await _route("pay_something")
+
+    update.callback_query.edit_message_text.assert_awaited_once_with("Неизвестная команда платежной системы")
+    handlers["initiate_payment"].assert_not_awaited()
+
+
+@pytest.mark.parametrize(
+    "data, handler, plan_id",
+    [
+        ("buy_plan_team_stars", "initiate_payment", "team"),
+        ("buy_plan_team_yukassa", "initiate_yukassa_payment", "team"),
+        ("buy_plan_team", "initiate_payment", "team"),
+        ("buy_plan_team_pro_yukassa", "initiate_yukassa_payment", "team_pro"),
+    ],
+)
+async def test_db_only_plans_fall_back_to_prefix_parsing(handlers, data, handler, plan_id):
+    assert data not in payments._CALLBACK_HANDLERS
+
+    update, context = await _route(data)
+
+    handlers[handler].assert_awaited_once_with(update, context, plan_id)
+
+
+@pytest.mark.parametrize("data", ["buy_plan_", "buy_plan__stars", "buy_plan__yukassa"])
+async def test_empty_plan_id_is_an_unknown_command(handlers, data):
+    update, _ = await _route(data)
+
+    update.callback_query.edit_message_text.assert_awaited_once_with("Неизвестная команда платежной системы")
+    handlers["initiate_payment"].assert_not_awaited()
+    handlers["initiate_yukassa_payment"].assert_not_awaited()
+
+
+async def test_bot_callback_router_delegates_buy_plan_to_payments(monkeypatch):
+    delegate = AsyncMock()
+    monkeypatch.setattr(callbacks, "handle_payment_callback", delegate)
+    monkeypatch.setattr(callbacks, "log_event", MagicMock())
+    monkeypatch.setattr(callbacks, "log_step", MagicMock())
+    update = _callback_update("buy_plan_team_yukassa")
+    update.callback_query.answer = AsyncMock()
+    context = MagicMock()
+
+    await callbacks.handle_callback_query(update, context)
+
+    delegate.assert_awaited_once_with(update, context)
+    event = callbacks.log_event.call_args.args
+    assert event[1:] == ("bot_button_buy_plan", {"callback_data": "buy_plan_team_yukassa", "payment_method": "yukassa"})
+
+
+def test_payment_semaphore_is_sized_by_the_concurrency_limit():
+    assert payments._PAYMENT_SEM._value == payments.PAYMENT_CALLBACK_CONCURRENCY
+
+
+@pytest.mark.parametrize("initiate", ["initiate_payment", "initiate_yukassa_payment"])
+async def test_concurrent_payment_initiations_are_bounded(monkeypatch, initiate):
+    limit = 3
+    # A fresh semaphore keeps the test independent of the loop the module one was used on
+    monkeypatch.setattr(payments, "_PAYMENT_SEM", asyncio.Semaphore(limit))
+    monkeypatch.setattr(payments, "log_step", MagicMock())
+    active = peak = 0
+
+    async def slow_resolve(plan_id):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        return None
+
+    monkeypatch.setattr(payments, "_resolve_plan", slow_resolve)
+    updates = [_callback_update("buy_plan_pro_stars") for _ in range(limit * 3)]
+
+    await asyncio.gather(*(getattr(payments, initiate)(u, MagicMock(), "pro") for u in updates))
+
+    assert peak == limit
+    for update in updates:
+        update.callback_query.edit_message_text.assert_awaited_once()
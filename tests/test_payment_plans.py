@@ -0,0 +1,121 @@
+"""Tests for the in-process plan catalog and the plans keyboard."""
+import dataclasses
+import threading
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from transkribator_modules.bot import payments
+from transkribator_modules.db.models import Plan
+
+
+@pytest.fixture(autouse=True)
+def catalog_db(sqlite_session, monkeypatch):
+    monkeypatch.setattr(payments, "SessionLocal", sqlite_session)
+    monkeypatch.setattr(payments, "_plans_cache", None)
+    return sqlite_session
+
+
+def _add_plans(Session, *plans):
+    with Session() as session:
+        session.add_all(plans)
+        session.commit()
+
+
+async def test_catalog_is_reused_within_ttl_and_reloaded_after(catalog_db):
+    first = await payments._get_catalog()
+    _add_plans(catalog_db, Plan(name="team", display_name="Team", price_rub=500.0))
+
+    assert await payments._get_catalog() is first
+    assert "team" not in first.by_name
+
+    # Age the snapshot past its TTL instead of sleeping
+    payments._plans_cache = dataclasses.replace(
+        first, loaded_at=first.loaded_at - payments._PLANS_CACHE_TTL - 1
+    )
+    reloaded = await payments._get_catalog()
+
+    assert reloaded is not first
+    assert "team" in reloaded.by_name
+
+
+async def test_catalog_is_loaded_off_the_event_loop_thread(monkeypatch):
+    load_plans = payments._load_plans
+    threads = []
+
+    def recording_load():
+        threads.append(threading.current_thread())
+        return load_plans()
+
+    monkeypatch.setattr(payments, "_load_plans", recording_load)
+
+    catalog = await payments._get_catalog()
+
+    assert threads and threads[0] is not threading.main_thread()
+    assert "pro" in catalog.by_name
+
+
+def test_catalog_is_ordered_by_plan_rank_then_unknown_plans(catalog_db):
+    _add_plans(
+        catalog_db,
+        Plan(name="team", display_name="Team"),
+        Plan(name="unlimited_year", display_name="Year"),
+        Plan(name="free", display_name="Free"),
+        Plan(name="unlimited", display_name="Unlimited"),
+        Plan(name="basic", display_name="Basic"),
+    )
+
+    catalog = payments._load_plans()
+
+    assert list(catalog.by_name) == ["free", "basic", "pro", "unlimited", "unlimited_year", "team"]
+
+
+def test_plan_buttons_skip_inactive_free_and_hidden_plans(catalog_db):
+    _add_plans(
+        catalog_db,
+        Plan(name="free", display_name="Free", is_active=True),
+        Plan(name="basic", display_name="Basic", is_active=True),
+        Plan(name=payments.PlanType.BETA.value, display_name="Beta", is_active=True),
+        Plan(name="team", display_name="Team", price_rub=500.0, is_active=False),
+        Plan(name="gift", display_name="Gift", price_stars=100, is_active=True),
+    )
+
+    catalog = payments._load_plans()
+
+    # Inactive plans stay in by_name for pre-checkout and resolution, but get no buttons
+    assert "team" in catalog.by_name
+    assert catalog.buttons == (
+        ("pro", "PRO", True, True),
+        ("gift", "Gift", True, False),
+    )
+
+
+def test_plans_markup_is_built_once_per_catalog_snapshot():
+    payments._build_plans_markup.cache_clear()
+    buttons = (("pro", "PRO", True, True), ("gift", "Gift", True, False))
+
+    markup = payments._build_plans_markup(buttons)
+
+    assert payments._build_plans_markup(tuple(buttons)) is markup
+    assert payments._build_plans_markup(buttons[:1]) is not markup
+    rows = [[button.callback_data for button in row] for row in markup.inline_keyboard]
+    assert rows == [
+        ["buy_plan_pro_stars"],
+        ["buy_plan_pro_yukassa"],
+        ["buy_plan_gift_stars"],
+        ["personal_cabinet"],
+    ]
+
+
+async def test_show_payment_plans_reuses_the_markup_between_renders(monkeypatch):
+    monkeypatch.setattr(payments, "log_step", MagicMock())
+    updates = []
+    for _ in range(2):
+        update = MagicMock()
+        update.callback_query.edit_message_text = AsyncMock()
+        await payments.show_payment_plans(update, MagicMock())
+        updates.append(update)
+
+    first, second = (u.callback_query.edit_message_text.await_args.kwargs for u in updates)
+    assert first["reply_markup"] is second["reply_markup"]
+    assert first["entities"] == payments._PLANS_ENTITIES
@@ -0,0 +1,240 @@
+"""Tests for Telegram payment handling in transkribator_modules.bot.payments."""
+import asyncio
+import contextlib
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from transkribator_modules.bot import payments
+from transkribator_modules.db.models import Plan, Transaction, User
+
+
+@pytest.fixture(autouse=True)
+def payments_db(sqlite_session, monkeypatch):
+    monkeypatch.setattr(payments, "SessionLocal", sqlite_session)
+    monkeypatch.setattr(payments, "log_step", MagicMock())
+    monkeypatch.setattr(payments, "_PROCESSED_CHARGES", {})
+    # The batch queue is bound to the event loop of the test that created it
+    monkeypatch.setattr(payments, "_payment_queue", None)
+    monkeypatch.setattr(payments, "_payment_flusher", None)
+    return sqlite_session
+
+
+@pytest.fixture
+async def payment_flusher():
+    yield
+    # Stop the background writer while the test's event loop is still running
+    flusher = payments._payment_flusher
+    if flusher is not None:
+        flusher.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await flusher
+
+
+def _payment(charge_id, payload="plan_pro"):
+    return SimpleNamespace(
+        currency="XTR",
+        total_amount=230,
+        invoice_payload=payload,
+        telegram_payment_charge_id=charge_id,
+        provider_payment_charge_id=f"prov-{charge_id}",
+    )
+
+
+def _payment_update(user_id, payment):
+    update = MagicMock()
+    update.effective_user.id = user_id
+    update.message.successful_payment = payment
+    update.message.reply_text = AsyncMock()
+    return update
+
+
+def _transactions(Session):
+    with Session() as session:
+        return [
+            (t.telegram_payment_charge_id, t.status, t.plan_type)
+            for t in session.query(Transaction).order_by(Transaction.id)
+        ]
+
+
+def test_claim_charge_accepts_each_charge_once():
+    assert payments._claim_charge("charge-0") is True
+    assert payments._claim_charge("charge-0") is False
+    # Payments without a charge id cannot be deduplicated and are always processed
+    assert payments._claim_charge(None) is True
+    assert payments._claim_charge(None) is True
+
+
+async def test_successful_payment_is_applied_once_per_charge_id(payments_db, payment_flusher):
+    first = _payment_update(42, _payment("charge-1"))
+    await payments.handle_successful_payment(first, MagicMock())
+
+    # A redelivery after a restart: the in-memory guard is gone, the unique index is not
+    payments._PROCESSED_CHARGES.clear()
+    second = _payment_update(42, _payment("charge-1"))
+    await payments.handle_successful_payment(second, MagicMock())
+
+    assert _transactions(payments_db) == [("charge-1", "completed", "pro")]
+    first.message.reply_text.assert_awaited_once()
+    assert "успешно" in first.message.reply_text.await_args.args[0]
+    second.message.reply_text.assert_not_awaited()
+    with payments_db() as session:
+        assert session.query(User).filter(User.telegram_id == 42).one().current_plan == "pro"
+
+
+def test_strikethrough_offsets_are_utf16():
+    text = "💎 Тариф — 4900₽ 8400₽"
+    (entity,) = payments._strikethrough_entities(text, "8400₽")
+
+    # The emoji is one Python character but two UTF-16 code units
+    assert entity.offset == text.index("8400₽") + 1
+    assert entity.length == 5
+    assert payments._utf16_len("💎") == 2
+
+
+def test_plans_text_entity_points_at_old_price():
+    (entity,) = payments._PLANS_ENTITIES
+    encoded = payments._PLANS_TEXT.encode("utf-16-le")
+    crossed = encoded[entity.offset * 2:(entity.offset + entity.length) * 2].decode("utf-16-le")
+    assert crossed == "8400₽"
+
+
+async def test_failed_upgrade_keeps_the_payment_and_reports_it(payments_db, payment_flusher):
+    update = _payment_update(7, _payment("charge-2", payload="plan_gone"))
+
+    await payments.handle_successful_payment(update, MagicMock())
+
+    assert _transactions(payments_db) == [("charge-2", "upgrade_failed", "gone")]
+    reply = update.message.reply_text.await_args.args[0]
+    assert reply.startswith("⚠️")
+    assert "charge-2" in reply
+
+
+async def test_persist_failure_releases_the_charge_for_redelivery(payment_flusher, monkeypatch):
+    def broken_batch(items):
+        raise RuntimeError("db is down")
+
+    monkeypatch.setattr(payments, "_persist_payment_batch", broken_batch)
+    update = _payment_update(8, _payment("charge-3"))
+
+    await payments.handle_successful_payment(update, MagicMock())
+
+    assert "charge-3" not in payments._PROCESSED_CHARGES
+    assert update.message.reply_text.await_args.args[0].startswith("⚠️")
+
+
+def test_payment_batch_isolates_each_item_in_a_savepoint(payments_db):
+    results = payments._persist_payment_batch([
+        (1, "pro", _payment("charge-a")),
+        (2, "pro", _payment("charge-a")),
+        (3, "gone", _payment("charge-b")),
+        (4, "pro", _payment("charge-c")),
+    ])
+
+    assert results == [
+        payments._PAYMENT_APPLIED,
+        payments._PAYMENT_DUPLICATE,
+        payments._PAYMENT_UPGRADE_FAILED,
+        payments._PAYMENT_APPLIED,
+    ]
+    assert _transactions(payments_db) == [
+        ("charge-a", "completed", "pro"),
+        ("charge-b", "upgrade_failed", "gone"),
+        ("charge-c", "completed", "pro"),
+    ]
+    with payments_db() as session:
+        plans = {u.telegram_id: u.current_plan for u in session.query(User)}
+    # The duplicate's savepoint rolled back together with the user row it created
+    assert 2 not in plans
+    assert plans[1] == plans[4] == "pro"
+    assert plans[3] != "pro"
+
+
+def test_payment_batch_locks_all_users_before_applying(monkeypatch):
+    events = []
+    monkeypatch.setattr(
+        payments.UserService, "lock_user_plans",
+        lambda self, ids: events.append(("lock", sorted(ids))),
+    )
+    monkeypatch.setattr(
+        payments, "_apply_payment_isolated",
+        lambda db, us, ts, user_id, plan_name, payment: events.append(("apply", user_id)) or "applied",
+    )
+
+    payments._persist_payment_batch([(9, "pro", None), (3, "pro", None), (9, "pro", None)])
+
+    assert events == [("lock", [3, 9, 9]), ("apply", 9), ("apply", 3), ("apply", 9)]
+
+
+async def test_flusher_persists_queued_payments_as_one_batch(payment_flusher, monkeypatch):
+    batches = []
+
+    def record_batch(items):
+        batches.append([user_id for user_id, _, _ in items])
+        return [payments._PAYMENT_APPLIED] * len(items)
+
+    monkeypatch.setattr(payments, "_persist_payment_batch", record_batch)
+
+    results = await asyncio.gather(*(payments._persist_payment(uid, "pro", None) for uid in (1, 2, 3)))
+
+    assert results == [payments._PAYMENT_APPLIED] * 3
+    # Everything already queued when the flusher wakes up goes into one batch
+    assert batches == [[1, 2, 3]]
+
+
+@pytest.fixture
+def plans_cache(monkeypatch):
+    # Start every catalog test from a cold process-wide cache
+    monkeypatch.setattr(payments, "_plans_cache", None)
+
+
+@pytest.mark.parametrize(
+    "payload, expected",
+    [
+        ("plan_pro", True),
+        ("plan_unlimited_year", True),
+        ("plan_missing", False),
+        ("pro", False),
+        ("", False),
+        (None, False),
+        ("plan_" + "x" * 64, False),
+    ],
+)
+async def test_is_known_payload(plans_cache, payload, expected):
+    assert await payments._is_known_payload(payload) is expected
+
+
+async def test_is_known_payload_loads_catalog_for_db_only_plan(payments_db, plans_cache):
+    with payments_db() as session:
+        session.add(Plan(name="team", display_name="Team", is_active=True))
+        session.commit()
+
+    assert payments._plans_cache is None
+    assert await payments._is_known_payload("plan_team") is True
+    assert "team" in payments._plans_cache.by_name
+
+
+async def test_pre_checkout_rejects_unknown_payload(plans_cache):
+    update = MagicMock()
+    update.pre_checkout_query.invoice_payload = '{"plan": "pro"}'
+    update.pre_checkout_query.answer = AsyncMock()
+
+    await payments.handle_pre_checkout_query(update, MagicMock())
+
+    update.pre_checkout_query.answer.assert_awaited_once_with(
+        ok=False, error_message="Неверный формат платежа"
+    )
+
+
+async def test_pre_checkout_accepts_db_only_plan_after_restart(payments_db, plans_cache):
+    with payments_db() as session:
+        session.add(Plan(name="team", display_name="Team", is_active=True))
+        session.commit()
+    update = MagicMock()
+    update.pre_checkout_query.invoice_payload = "plan_team"
+    update.pre_checkout_query.answer = AsyncMock()
+
+    await payments.handle_pre_checkout_query(update, MagicMock())
+
+    update.pre_checkout_query.answer.assert_awaited_once_with(ok=True)
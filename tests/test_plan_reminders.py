@@ -0,0 +1,205 @@
+"""Tests for reminder pacing and Telegram 429 handling in plan_reminders."""
+from datetime import datetime
+
+import httpx
+import pytest
+
+from transkribator_modules.db import database as db_module
+from transkribator_modules.jobs import plan_reminders
+from transkribator_modules.jobs.plan_reminders import (
+    EXPIRED_KIND,
+    PlanNotification,
+    _SendPacer,
+    _dispatch_notifications,
+    _retry_after_seconds,
+)
+
+
+class FakeClock:
+    """Stands in for the ``time`` module: sleeping only advances the clock."""
+
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(round(seconds, 6))
+        self.now += seconds
+
+
+class FakeClient:
+    """httpx.Client replacement that replays scripted responses and records chat ids."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.chats = []
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def post(self, url, json):
+        self.chats.append(json["chat_id"])
+        status, body, headers = self.responses.pop(0) if self.responses else (200, {"ok": True}, {})
+        return httpx.Response(status, json=body, headers=headers, request=httpx.Request("POST", url))
+
+
+def _ok():
+    return (200, {"ok": True}, {})
+
+
+def _flood(retry_after):
+    return (429, {"ok": False, "parameters": {"retry_after": retry_after}}, {})
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(plan_reminders, "time", fake)
+    return fake
+
+
+@pytest.fixture
+def logged(monkeypatch):
+    events = []
+    monkeypatch.setattr(db_module, "log_event", lambda user_id, kind, payload: events.append(user_id))
+    return events
+
+
+def _client(monkeypatch, *responses):
+    client = FakeClient(responses)
+    monkeypatch.setattr(plan_reminders.httpx, "Client", client)
+    return client
+
+
+def _notification(n):
+    return PlanNotification(
+        user_id=n,
+        telegram_id=1000 + n,
+        kind=EXPIRED_KIND,
+        plan_expires_at=datetime(2026, 1, 1),
+        message=f"reminder {n}",
+    )
+
+
+def test_pacer_sleeps_only_when_the_window_budget_is_spent(clock):
+    pacer = _SendPacer(rate=3, window=1.0)
+
+    for _ in range(3):
+        pacer.wait()
+    assert clock.sleeps == []
+
+    clock.now += 0.25
+    pacer.wait()
+    assert clock.sleeps == [0.75]
+    assert pacer.sent_in_window == 1
+
+
+def test_pacer_starts_a_new_window_after_it_elapses(clock):
+    pacer = _SendPacer(rate=2, window=1.0)
+    pacer.wait()
+    pacer.wait()
+
+    clock.now += 1.5
+    pacer.wait()
+
+    assert clock.sleeps == []
+    assert pacer.sent_in_window == 1
+
+
+def test_pacer_pause_holds_the_next_send_and_resets_the_window(clock):
+    pacer = _SendPacer(rate=2, window=1.0)
+    pacer.wait()
+    pacer.pause(3.0)
+    pacer.pause(1.0)  # a shorter pause never shortens an active one
+
+    pacer.wait()
+
+    assert clock.sleeps == [3.0]
+    assert pacer.sent_in_window == 1
+
+
+def _response(status, body=None, headers=None, content=None):
+    request = httpx.Request("POST", "https://api.telegram.org/botX/sendMessage")
+    if content is not None:
+        return httpx.Response(status, content=content, headers=headers, request=request)
+    return httpx.Response(status, json=body, headers=headers, request=request)
+
+
+@pytest.mark.parametrize(
+    "response, expected",
+    [
+        (_response(200, {"ok": True}), None),
+        (_response(400, {"ok": False}), None),
+        (_response(429, {"ok": False, "parameters": {"retry_after": 7}}), 7.0),
+        (_response(429, content=b"Too Many Requests", headers={"Retry-After": "3"}), 3.0),
+        (_response(429, {"ok": False}, headers={"Retry-After": "5"}), 5.0),
+        (_response(429, content=b"", headers={"Retry-After": "Wed, 21 Oct 2026 07:28:00 GMT"}), 1.0),
+        (_response(429, {"ok": False}), 1.0),
+    ],
+)
+def test_retry_after_seconds(response, expected):
+    assert _retry_after_seconds(response) == expected
+
+
+def test_no_wait_mode_never_sleeps_on_a_flood_wait(monkeypatch, clock, logged):
+    client = _client(monkeypatch, _flood(30))
+
+    sent = _dispatch_notifications([_notification(1)], wait_on_rate_limit=False)
+
+    assert sent == 0
+    assert clock.sleeps == []
+    assert client.chats == [1001]
+    assert logged == []
+
+
+def test_flood_wait_pauses_everyone_and_retries_the_rejected_chat_first(monkeypatch, clock, logged):
+    client = _client(monkeypatch, _ok(), _flood(2), _ok(), _ok())
+
+    sent = _dispatch_notifications([_notification(1), _notification(2), _notification(3)])
+
+    assert sent == 3
+    assert client.chats == [1001, 1002, 1002, 1003]
+    assert clock.sleeps == [2.0]
+    assert logged == [1, 2, 3]
+
+
+def test_repeated_flood_waits_back_off_exponentially(monkeypatch, clock, logged):
+    client = _client(monkeypatch, _flood(1), _flood(1), _ok())
+
+    sent = _dispatch_notifications([_notification(1)])
+
+    assert sent == 1
+    assert client.chats == [1001, 1001, 1001]
+    assert clock.sleeps == [1.0, 2.0]
+
+
+def test_flood_wait_beyond_the_budget_stops_the_run(monkeypatch, clock, logged):
+    client = _client(monkeypatch, _ok(), _flood(plan_reminders.RATE_LIMIT_PAUSE_BUDGET + 1))
+
+    sent = _dispatch_notifications([_notification(1), _notification(2), _notification(3)])
+
+    # Nothing is recorded for the rest, so the next run sends them
+    assert sent == 1
+    assert client.chats == [1001, 1002]
+    assert clock.sleeps == []
+    assert logged == [1]
+
+
+def test_total_pause_per_run_is_capped_by_the_budget(monkeypatch, clock, logged):
+    client = _client(monkeypatch, _flood(2), _flood(2), _ok())
+
+    sent = _dispatch_notifications([_notification(1)])
+
+    # 2s fits the 5s budget; the 4s backoff that follows does not
+    assert sent == 0
+    assert client.chats == [1001, 1001]
+    assert sum(clock.sleeps) <= plan_reminders.RATE_LIMIT_PAUSE_BUDGET
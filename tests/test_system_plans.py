@@ -0,0 +1,69 @@
+"""Tests for the plan listing in core_api.api.v1.system."""
+import pytest
+
+from core_api.api.v1 import system
+from transkribator_modules.db.models import Plan
+
+
+@pytest.fixture(autouse=True)
+def plans_db(sqlite_session):
+    system._parse_features.cache_clear()
+    with sqlite_session() as session:
+        pro = session.query(Plan).filter(Plan.name == "pro").one()
+        pro.minutes_per_month = 600
+        pro.price_rub = 299
+        pro.price_usd = 4
+        pro.features = '["Приоритет", "Файлы до 2 ГБ"]'
+        session.add_all([
+            Plan(name="legacy", display_name="Legacy", minutes_per_month=60, features="Одна строка"),
+            Plan(name="scalar", display_name="Scalar", minutes_per_month=60, features='"text"'),
+            Plan(name="empty", display_name="Empty", minutes_per_month=30, description="Без фич"),
+            Plan(name="hidden", display_name="Hidden", minutes_per_month=30, is_active=False),
+        ])
+        session.commit()
+    return sqlite_session
+
+
+@pytest.mark.parametrize(
+    "raw, expected",
+    [
+        ('["a", "b"]', ("a", "b")),
+        ("[]", ()),
+        ("not json", ("not json",)),
+        ('{"a": 1}', ('{"a": 1}',)),
+        ('"text"', ('"text"',)),
+    ],
+)
+def test_parse_features(raw, expected):
+    assert system._parse_features(raw) == expected
+
+
+def test_parse_features_memoizes_by_raw_string():
+    first = system._parse_features('["a"]')
+
+    assert system._parse_features('["a"]') is first
+    assert system._parse_features.cache_info().hits == 1
+
+
+async def test_plans_endpoint_lists_active_plans_with_feature_lists():
+    plans = {plan.name: plan for plan in await system.get_plans_endpoint()}
+
+    assert set(plans) == {"pro", "legacy", "scalar", "empty"}
+    assert plans["pro"].features == ["Приоритет", "Файлы до 2 ГБ"]
+    assert plans["pro"].minutes_per_month == 600
+    assert plans["pro"].price_rub == 299
+    # Malformed or non-list JSON is exposed as a single feature instead of failing
+    assert plans["legacy"].features == ["Одна строка"]
+    assert plans["scalar"].features == ['"text"']
+    assert plans["empty"].features == []
+    assert plans["empty"].description == "Без фич"
+    assert plans["legacy"].description == ""
+
+
+async def test_plans_endpoint_returns_independent_feature_lists():
+    first = {plan.name: plan for plan in await system.get_plans_endpoint()}
+    first["pro"].features.append("mutated")
+
+    second = {plan.name: plan for plan in await system.get_plans_endpoint()}
+
+    assert second["pro"].features == ["Приоритет", "Файлы до 2 ГБ"]
@@ -0,0 +1,52 @@
+"""Tests for the per-user plan advisory lock in UserService."""
+from unittest.mock import MagicMock
+
+from transkribator_modules.db import database as db_module
+from transkribator_modules.db.database import UserService
+
+
+def _postgres_session():
+    session = MagicMock()
+    session.get_bind.return_value.dialect.name = "postgresql"
+    return session
+
+
+def _locked_keys(session):
+    return [c.args[1]["uid"] for c in session.execute.call_args_list]
+
+
+def test_lock_user_plans_takes_keys_in_ascending_order():
+    session = _postgres_session()
+
+    UserService(session).lock_user_plans([900, 5, 42, 5])
+
+    assert _locked_keys(session) == [5, 42, 900]
+    assert {c.args[1]["ns"] for c in session.execute.call_args_list} == {db_module._USER_PLAN_LOCK_NS}
+
+
+def test_lock_user_plans_orders_by_lock_key_for_large_ids():
+    session = _postgres_session()
+    big = (1 << 31) + 7  # Telegram ids exceed int32; the key wraps to 7
+
+    UserService(session).lock_user_plans([100, big])
+
+    assert _locked_keys(session) == [7, 100]
+
+
+def test_lock_user_plan_emits_transaction_scoped_advisory_lock():
+    session = _postgres_session()
+
+    UserService(session).lock_user_plan(123)
+
+    (call,) = session.execute.call_args_list
+    assert str(call.args[0]) == "SELECT pg_advisory_xact_lock(:ns, :uid)"
+    assert call.args[1] == {"ns": db_module._USER_PLAN_LOCK_NS, "uid": 123}
+
+
+def test_lock_user_plan_is_a_noop_on_sqlite(sqlite_session):
+    with sqlite_session() as session:
+        session.execute = MagicMock(wraps=session.execute)
+
+        UserService(session).lock_user_plan(123)
+
+        session.execute.assert_not_called()
@@ -0,0 +1,162 @@
+"""Tests for the ЮКасса webhook handler and webhook verification."""
+import json
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from transkribator_modules.bot import yukassa_webhook
+from transkribator_modules.db.database import TransactionService, UserService
+from transkribator_modules.db.models import Transaction, User
+from transkribator_modules.payments.yukassa import YukassaPaymentService
+
+YUKASSA_HOST = "185.71.76.1"
+
+
+@pytest.fixture(autouse=True)
+def webhook_db(sqlite_session, monkeypatch):
+    monkeypatch.setattr(yukassa_webhook, "SessionLocal", sqlite_session)
+    monkeypatch.setattr(yukassa_webhook, "record_yukassa_webhook_status", MagicMock())
+    return sqlite_session
+
+
+@pytest.fixture
+def service(monkeypatch):
+    svc = MagicMock()
+    monkeypatch.setattr(yukassa_webhook, "get_yukassa_service", lambda: svc)
+    return svc
+
+
+def _request(host=YUKASSA_HOST, event="payment.succeeded", payment_id="pay-1"):
+    request = MagicMock()
+    request.client.host = host
+    request.json = AsyncMock(return_value={"event": event, "object": {"id": payment_id}})
+    return request
+
+
+def _payment_info(payment_id="pay-1", user_id=42, plan_type="pro"):
+    return {
+        "payment_id": payment_id,
+        "status": "succeeded",
+        "amount": 299.0,
+        "metadata": {"user_id": str(user_id), "plan_type": plan_type},
+    }
+
+
+def _status(response):
+    return response.status_code, json.loads(response.body)["status"]
+
+
+async def test_webhook_applies_payment_once_per_payment_id(webhook_db, service):
+    service.process_webhook.return_value = _payment_info()
+
+    first = await yukassa_webhook.handle_yukassa_webhook(_request())
+    second = await yukassa_webhook.handle_yukassa_webhook(_request())
+
+    assert _status(first) == (200, "success")
+    assert _status(second) == (200, "duplicate")
+    with webhook_db() as session:
+        assert [t.external_payment_id for t in session.query(Transaction)] == ["pay-1"]
+        assert session.query(User).filter(User.telegram_id == 42).one().current_plan == "pro"
+
+
+async def test_webhook_rolls_back_payment_when_plan_is_unknown(webhook_db, service):
+    service.process_webhook.return_value = _payment_info(plan_type="gone")
+
+    response = await yukassa_webhook.handle_yukassa_webhook(_request())
+
+    # 500 makes ЮКасса redeliver; nothing is stored so the retry is not a duplicate
+    assert _status(response) == (500, "error")
+    with webhook_db() as session:
+        assert session.query(Transaction).count() == 0
+
+
+def test_exists_by_external_id_ignores_missing_ids(webhook_db):
+    with webhook_db() as session:
+        user = UserService(session).get_or_create_user(telegram_id=5)
+        # A Stars payment has no external id; it must not make an empty id look paid
+        TransactionService(session).create_transaction(user=user, plan_type="pro")
+        service = TransactionService(session)
+
+        assert service.exists_by_external_id(None) is False
+        assert service.exists_by_external_id("") is False
+
+
+async def test_webhook_rejects_foreign_address_when_ip_check_is_on(monkeypatch, service):
+    monkeypatch.setattr(yukassa_webhook, "YUKASSA_WEBHOOK_IP_CHECK", True)
+    request = _request(host="203.0.113.5")
+
+    response = await yukassa_webhook.handle_yukassa_webhook(request)
+
+    assert _status(response) == (403, "forbidden")
+    request.json.assert_not_awaited()
+    service.process_webhook.assert_not_called()
+
+
+async def test_webhook_allows_body_fallback_only_with_ip_check(monkeypatch, service):
+    service.process_webhook.return_value = _payment_info()
+
+    await yukassa_webhook.handle_yukassa_webhook(_request())
+    assert service.process_webhook.call_args.kwargs == {"allow_body_fallback": False}
+
+    monkeypatch.setattr(yukassa_webhook, "YUKASSA_WEBHOOK_IP_CHECK", True)
+    await yukassa_webhook.handle_yukassa_webhook(_request(payment_id="pay-2"))
+    assert service.process_webhook.call_args.kwargs == {"allow_body_fallback": True}
+
+
+async def test_webhook_asks_for_redelivery_of_unverified_payment(service):
+    service.process_webhook.return_value = None
+
+    unverified = await yukassa_webhook.handle_yukassa_webhook(_request())
+    other_event = await yukassa_webhook.handle_yukassa_webhook(_request(event="payment.canceled"))
+
+    assert _status(unverified) == (503, "unverified")
+    assert _status(other_event) == (200, "ignored")
+
+
+@pytest.mark.parametrize(
+    "host, expected",
+    [
+        ("185.71.76.1", True),
+        ("77.75.156.11", True),
+        ("2a02:5180::1", True),
+        ("77.75.156.12", False),
+        ("127.0.0.1", False),
+        ("not-an-ip", False),
+        (None, False),
+    ],
+)
+def test_is_yukassa_address(host, expected):
+    assert yukassa_webhook._is_yukassa_address(host) is expected
+
+
+def _body(status="succeeded"):
+    return {
+        "event": "payment.succeeded",
+        "object": {
+            "id": "pay-1",
+            "status": status,
+            "amount": {"value": "299.00", "currency": "RUB"},
+            "metadata": {"user_id": "42", "plan_type": "pro"},
+        },
+    }
+
+
+def test_process_webhook_ignores_body_unless_fallback_is_allowed():
+    svc = YukassaPaymentService.__new__(YukassaPaymentService)
+    svc.verify_payment = MagicMock(return_value=None)
+
+    assert svc.process_webhook(_body()) is None
+    fallback = svc.process_webhook(_body(), allow_body_fallback=True)
+
+    assert fallback["payment_id"] == "pay-1"
+    assert fallback["amount"] == 299.0
+    assert fallback["metadata"] == {"user_id": "42", "plan_type": "pro"}
+
+
+def test_process_webhook_prefers_verified_payment():
+    verified = _payment_info()
+    svc = YukassaPaymentService.__new__(YukassaPaymentService)
+    svc.verify_payment = MagicMock(return_value=verified)
+
+    assert svc.process_webhook(_body(status="pending")) is verified
+    svc.verify_payment.assert_called_once_with("pay-1")
@@ -27,7 +27,7 @@ from transkribator_modules.db.database import (
     ReferralService,
 )
 from transkribator_modules.db.models import ApiKey, PlanType
-from transkribator_modules.bot.payments import handle_payment_callback, show_payment_plans, initiate_payment, initiate_yukassa_payment
+from transkribator_modules.bot.payments import handle_payment_callback, show_payment_plans
 from transkribator_modules.bot.logging_utils import log_step, trace_handler
 from transkribator_modules.google_api import (
     GoogleCredentialService,
@@ -181,21 +181,8 @@ async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TY
         except Exception:
             logger.debug("Failed to log button event", exc_info=True)
             
-        if data.endswith("_stars"):
-            # Платеж через Telegram Stars
-            plan_id = data.replace("buy_plan_", "").replace("_stars", "")
-            logger.info(f"Обнаружен колбек оплаты плана через Stars: {data}, извлеченный plan_id: {plan_id}")
-            await initiate_payment(update, context, plan_id)
-        elif data.endswith("_yukassa"):
-            # Платеж через ЮКассу
-            plan_id = data.replace("buy_plan_", "").replace("_yukassa", "")
-            logger.info(f"Обнаружен колбек оплаты плана через ЮКассу: {data}, извлеченный plan_id: {plan_id}")
-            await initiate_yukassa_payment(update, context, plan_id)
-        else:
-            # Старый формат для обратной совместимости
-            plan_id = data.replace("buy_plan_", "")
-            logger.info(f"Обнаружен колбек оплаты плана (старый формат): {data}, извлеченный plan_id: {plan_id}")
-            await initiate_payment(update, context, plan_id)
+        # Разбор buy_plan_<plan>[_stars|_yukassa] — по таблице колбеков платежного модуля
+        await handle_payment_callback(update, context)
 
 
     elif data == "show_stats":
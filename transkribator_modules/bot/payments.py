@@ -2,16 +2,21 @@
 Модуль для работы с платежами в CyberKitty Transkribator
 """
 
-import json
-from datetime import datetime, timedelta
-from telegram import Update, LabeledPrice, InlineKeyboardButton, InlineKeyboardMarkup
+import asyncio
+import time
+from dataclasses import dataclass
+from functools import lru_cache, wraps
+from typing import Dict, Mapping
+from sqlalchemy import case
+from sqlalchemy.exc import IntegrityError
+from telegram import Update, LabeledPrice, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity
 from telegram.ext import ContextTypes
 
 from transkribator_modules.config import logger
-from transkribator_modules.db.database import SessionLocal, UserService, TransactionService, log_event
+from transkribator_modules.db.database import SessionLocal, UserService, TransactionService
 from transkribator_modules.bot.logging_utils import log_step
 from transkribator_modules.db.models import PlanType, Plan
-from transkribator_modules.payments.yukassa import YukassaPaymentService
+from transkribator_modules.payments.yukassa import get_yukassa_service
 
 # Цены в Telegram Stars (1 Star ≈ 1.3 рубля)
 PLAN_PRICES_STARS = {
@@ -77,30 +82,234 @@ PLAN_DESCRIPTIONS_EXTRA = {
 
 EXCLUDED_PLAN_TYPES = {PlanType.BETA}
 
+# Статичные тексты и клавиатуры собираются один раз при импорте модуля
+_PLANS_TEXT = (
+    "💎 Тарифы CyberKitty Transkribator\n"
+    "🆓 Бесплатный\n"
+    "• Безлимитные минуты\n"
+    "• 3 генерации в месяц\n"
+    "• Базовое качество\n\n"
+    "💎 Профессиональный — 299₽/мес\n"
+    "• 10 часов транскрибации\n"
+    "• Приоритетная обработка\n\n"
+    "🚀 Безлимитный — 699₽/мес\n"
+    "• Полный безлимит\n"
+    "• Максимальный приоритет\n\n"
+    "🚀 Безлимит на год — 4900₽/год 8400₽\n"
+    "• Безлимит на 12 месяцев\n"
+    "• Все функции включены"
+)
 
-def _resolve_plan_meta(enum_value, plan_name: str) -> dict:
-    if enum_value and enum_value in PLAN_DESCRIPTIONS:
-        return PLAN_DESCRIPTIONS.get(enum_value, {})
-    return PLAN_DESCRIPTIONS_EXTRA.get(plan_name, {})
 
+def _utf16_len(text: str) -> int:
+    # Смещения сущностей Telegram считаются в UTF-16 code units
+    return len(text.encode("utf-16-le")) // 2
 
-def _get_rub_price(plan: Plan, enum_value: PlanType | None) -> float | None:
+
+def _strikethrough_entities(text: str, fragment: str) -> tuple[MessageEntity, ...]:
+    start = text.index(fragment)
+    return (
+        MessageEntity(
+            type=MessageEntity.STRIKETHROUGH,
+            offset=_utf16_len(text[:start]),
+            length=_utf16_len(fragment),
+        ),
+    )
+
+
+# Разметка текста тарифов готовится один раз, Telegram не парсит HTML на каждый показ
+_PLANS_ENTITIES = _strikethrough_entities(_PLANS_TEXT, "8400₽")
+
+_PLANS_BACK_ROW = [InlineKeyboardButton("🔙 Назад", callback_data="personal_cabinet")]
+
+_BACK_TO_PLANS_ROW = [InlineKeyboardButton("🔙 Назад к тарифам", callback_data="show_payment_plans")]
+
+_SUCCESS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🏠 Личный кабинет", callback_data="personal_cabinet")]
+])
+
+# Обычный текст без parse_mode: название и описание плана приходят из БД и могут
+# содержать символы разметки; ссылка на оплату передаётся только кнопкой
+_YUKASSA_TMPL = """💳 Оплата через ЮКассу
+
+📦 План: {plan}
+💰 Сумма: {price}
+📝 Описание: {description}
+
+⚠️ Важно: После успешной оплаты ваша подписка будет активирована автоматически.
+
+💡 Если у вас возникли проблемы с оплатой, обратитесь в поддержку."""
+
+_SUCCESS_TMPL = """🎉 Платеж успешно обработан!
+
+💳 Сумма: {amount} {currency}
+📦 Товар: {payload}
+🎯 ID транзакции: {charge_id}
+
+✅ Ваша подписка активирована!
+
+Что теперь доступно:
+• Увеличенные лимиты транскрипции
+• Приоритетная обработка файлов
+• Расширенная техническая поддержка
+• Дополнительные функции ИИ
+
+Спасибо за использование CyberKitty Transkribator! 🐱✨"""
+
+# Платеж получен, но план не активирован (ошибка записи или апгрейда):
+# Telegram не доставит successful_payment повторно, поэтому просим обратиться в поддержку
+_ACTIVATION_FAILED_TMPL = """⚠️ Платеж получен, но активировать подписку автоматически не удалось.
+
+🎯 ID транзакции: {charge_id}
+
+Напишите в поддержку и укажите ID транзакции — подписку активируем вручную."""
+
+
+@dataclass(frozen=True, slots=True)
+class PlanRecord:
+    """Сводка по тарифу из статичных таблиц модуля."""
+
+    name: str
+    plan_type: PlanType | None
+    title: str
+    description: str
+    stars: int | None
+    rub: float | None
+
+
+def _build_plan_table() -> dict[str, PlanRecord]:
+    table: dict[str, PlanRecord] = {}
+    for plan_type in PlanType:
+        meta = PLAN_DESCRIPTIONS.get(plan_type, {})
+        table[plan_type.value] = PlanRecord(
+            name=plan_type.value,
+            plan_type=plan_type,
+            title=meta.get("title", ""),
+            description=meta.get("description", ""),
+            stars=PLAN_PRICES_STARS.get(plan_type),
+            rub=PLAN_PRICES_RUB.get(plan_type),
+        )
+    for plan_name, meta in PLAN_DESCRIPTIONS_EXTRA.items():
+        # Тарифы вне PlanType (например, годовой) оцениваются только по БД
+        table[plan_name] = PlanRecord(
+            name=plan_name,
+            plan_type=None,
+            title=meta.get("title", ""),
+            description=meta.get("description", ""),
+            stars=None,
+            rub=None,
+        )
+    return table
+
+
+_PLAN_TABLE: Mapping[str, PlanRecord] = _build_plan_table()
+
+# invoice_payload инвойсов Stars: plan_<id>
+_PAYLOAD_PREFIX = "plan_"
+_PAYLOAD_MAX_LEN = 64  # Telegram допускает до 128 байт; наши payload заметно короче
+
+# callback_data кнопок оплаты (Stars, ЮКасса) для известных тарифов
+_BUY_CALLBACKS: Mapping[str, tuple[str, str]] = {
+    name: (f"buy_plan_{name}_stars", f"buy_plan_{name}_yukassa") for name in _PLAN_TABLE
+}
+
+
+def _get_rub_price(plan: Plan, record: PlanRecord | None) -> float | None:
     if getattr(plan, "price_rub", None):
         return float(plan.price_rub)
-    if enum_value and enum_value in PLAN_PRICES_RUB:
-        return PLAN_PRICES_RUB[enum_value]
+    if record and record.rub is not None:
+        return record.rub
     return None
 
 
-def _get_stars_price(plan: Plan, enum_value: PlanType | None) -> int | None:
-    if enum_value and enum_value in PLAN_PRICES_STARS:
-        return PLAN_PRICES_STARS[enum_value]
+def _get_stars_price(plan: Plan, record: PlanRecord | None) -> int | None:
+    if record and record.stars:
+        return record.stars
     raw = getattr(plan, "price_stars", None)
     if raw:
         return int(raw)
     return None
 
 
+# Идемпотентность successful_payment: Telegram может доставить апдейт повторно
+_PROCESSED_CHARGES: Dict[str, float] = {}
+_PROCESSED_CHARGES_TTL = 3600.0  # seconds
+
+
+def _claim_charge(charge_id: str | None) -> bool:
+    """Return False if this Telegram charge was already handled by this process."""
+    if not charge_id:
+        return True
+    now = time.time()
+    if _PROCESSED_CHARGES and len(_PROCESSED_CHARGES) % 64 == 0:
+        cutoff = now - _PROCESSED_CHARGES_TTL
+        for k in list(_PROCESSED_CHARGES.keys()):
+            if _PROCESSED_CHARGES[k] < cutoff:
+                _PROCESSED_CHARGES.pop(k, None)
+    if charge_id in _PROCESSED_CHARGES:
+        return False
+    _PROCESSED_CHARGES[charge_id] = now
+    return True
+
+
+# Каталог тарифов меняется редко: держим строки Plan в памяти процесса
+_PLANS_CACHE_TTL = 60.0  # seconds
+
+
+@dataclass(frozen=True, slots=True)
+class _PlansCatalog:
+    loaded_at: float
+    by_name: Dict[str, Plan]
+    # (name, display_name, has_stars, has_rub) для активных платных тарифов
+    buttons: tuple[tuple[str, str, bool, bool], ...]
+
+
+_plans_cache: _PlansCatalog | None = None
+
+
+def _plan_buttons(plans: list[Plan]) -> tuple[tuple[str, str, bool, bool], ...]:
+    buttons = []
+    for plan in plans:
+        if not plan.is_active or plan.name in _PLANS_WITHOUT_BUTTONS:
+            continue
+        record = _PLAN_TABLE.get(plan.name)
+        rub_price_value = _get_rub_price(plan, record)
+        buttons.append((
+            plan.name,
+            plan.display_name,
+            bool(_get_stars_price(plan, record)),
+            bool(rub_price_value and rub_price_value > 0),
+        ))
+    return tuple(buttons)
+
+
+def _load_plans() -> _PlansCatalog:
+    with SessionLocal() as session:
+        # Порядок каталога задаётся в SQL; dict и кнопки ниже его сохраняют
+        plans = session.query(Plan).order_by(case(_PLAN_ORDER, value=Plan.name, else_=100)).all()
+        # Отвязываем объекты, чтобы они оставались доступны после закрытия сессии
+        session.expunge_all()
+    return _PlansCatalog(
+        loaded_at=time.time(),
+        by_name={plan.name: plan for plan in plans},
+        buttons=_plan_buttons(plans),
+    )
+
+
+async def _get_catalog() -> _PlansCatalog:
+    """Возвращает каталог тарифов, перечитывая его из БД не чаще раза в минуту.
+
+    Запрос к БД выполняется в пуле потоков, чтобы не блокировать event loop.
+    Кнопки оплаты вычисляются один раз при загрузке каталога.
+    """
+    global _plans_cache
+    if _plans_cache is not None and time.time() - _plans_cache.loaded_at < _PLANS_CACHE_TTL:
+        return _plans_cache
+
+    _plans_cache = await asyncio.to_thread(_load_plans)
+    return _plans_cache
+
+
 def _get_target_message(update: Update):
     if update.message:
         return update.message
@@ -117,135 +326,118 @@ async def _reply(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str,
         return await context.bot.send_message(chat_id=update.effective_user.id, text=text, **kwargs)
     return None
 
-async def show_payment_plans(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Показывает доступные тарифные планы."""
-    try:
-        logger.info("Вызвана функция show_payment_plans")
-        log_step(update, "payments:show_plans")
 
-        pass #session = SessionLocal()
-        try:
-            plans = (
-                session.query(Plan)
-                .filter(Plan.is_active == True)
-                .all()
-            )
-            excluded_names = {plan_type.value for plan_type in EXCLUDED_PLAN_TYPES}
-            plans = [plan for plan in plans if plan.name not in excluded_names]
-        finally:
-            session.close()
-
-        order = {
-            PlanType.FREE.value: 0,
-            PlanType.BASIC.value: 1,
-            PlanType.PRO.value: 2,
-            PlanType.UNLIMITED.value: 3,
-            UNLIMITED_YEAR_PLAN: 4,
-        }
-
-        plans.sort(key=lambda p: order.get(p.name, 100))
-
-        plans_text = (
-            "💎 Тарифы CyberKitty Transkribator\n"
-            "🆓 Бесплатный\n"
-            "• Безлимитные минуты\n"
-            "• 3 генерации в месяц\n"
-            "• Базовое качество\n\n"
-            "💎 Профессиональный — 299₽/мес\n"
-            "• 10 часов транскрибации\n"
-            "• Приоритетная обработка\n\n"
-            "🚀 Безлимитный — 699₽/мес\n"
-            "• Полный безлимит\n"
-            "• Максимальный приоритет\n\n"
-            "🚀 Безлимит на год — 4900₽/год <s>8400₽</s>\n"
-            "• Безлимит на 12 месяцев\n"
-            "• Все функции включены"
-        )
+_PLAN_ORDER = {
+    PlanType.FREE.value: 0,
+    PlanType.BASIC.value: 1,
+    PlanType.PRO.value: 2,
+    PlanType.UNLIMITED.value: 3,
+    UNLIMITED_YEAR_PLAN: 4,
+}
 
-        keyboard = []
+# Бесплатные и скрытые тарифы не получают кнопок оплаты
+_PLANS_WITHOUT_BUTTONS = frozenset(
+    {PlanType.FREE.value, PlanType.BASIC.value}
+    | {plan_type.value for plan_type in EXCLUDED_PLAN_TYPES}
+)
 
-        for plan in plans:
-            name = plan.name
-            display_name = plan.display_name
-            if name == PlanType.FREE.value or name == PlanType.BASIC.value:
-                continue
 
-            enum_value = None
-            try:
-                enum_value = PlanType(name)
-            except ValueError:
-                pass
+@lru_cache(maxsize=8)
+def _build_plans_markup(buttons: tuple[tuple[str, str, bool, bool], ...]) -> InlineKeyboardMarkup:
+    """Клавиатура тарифов зависит только от каталога, поэтому кешируется по его снимку."""
+    keyboard = []
+    for name, display_name, has_stars, has_rub in buttons:
+        stars_data, yukassa_data = _BUY_CALLBACKS.get(name) or (
+            f"buy_plan_{name}_stars", f"buy_plan_{name}_yukassa"
+        )
+        if has_stars:
+            keyboard.append([
+                InlineKeyboardButton(f"{display_name} (Stars)", callback_data=stars_data)
+            ])
+        if has_rub:
+            keyboard.append([
+                InlineKeyboardButton(f"{display_name} (ЮКасса)", callback_data=yukassa_data)
+            ])
+    keyboard.append(_PLANS_BACK_ROW)
+    return InlineKeyboardMarkup(keyboard)
 
-            if enum_value and enum_value in EXCLUDED_PLAN_TYPES:
-                continue
 
-            stars_price = _get_stars_price(plan, enum_value)
-            if stars_price:
-                keyboard.append([
-                    InlineKeyboardButton(
-                        f"{display_name} (Stars)",
-                        callback_data=f"buy_plan_{name}_stars"
-                    )
-                ])
-            rub_price_value = _get_rub_price(plan, enum_value)
-            if rub_price_value and rub_price_value > 0:
-                keyboard.append([
-                    InlineKeyboardButton(
-                        f"{display_name} (ЮКасса)",
-                        callback_data=f"buy_plan_{name}_yukassa"
-                    )
-                ])
-
-        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="personal_cabinet")])
-
-        reply_markup = InlineKeyboardMarkup(keyboard)
+async def show_payment_plans(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает доступные тарифные планы."""
+    try:
+        logger.info("Вызвана функция show_payment_plans")
+        log_step(update, "payments:show_plans")
+
+        reply_markup = _build_plans_markup((await _get_catalog()).buttons)
 
         if update.callback_query:
             await update.callback_query.edit_message_text(
-                plans_text, reply_markup=reply_markup, parse_mode='HTML'
+                _PLANS_TEXT, reply_markup=reply_markup, entities=_PLANS_ENTITIES
             )
         else:
-            await _reply(update, context, plans_text, reply_markup=reply_markup, parse_mode='HTML')
+            await _reply(update, context, _PLANS_TEXT, reply_markup=reply_markup, entities=_PLANS_ENTITIES)
 
     except Exception as e:
-        logger.error(f"Ошибка при показе планов: {e}")
+        logger.exception("Ошибка при показе планов: %s", e)
         await _reply(update, context, "❌ Ошибка при загрузке тарифных планов")
 
+@dataclass(frozen=True, slots=True)
+class _ResolvedPlan:
+    plan: Plan
+    record: PlanRecord | None
+    display_name: str
+    description: str
+
+
+async def _resolve_plan(plan_id: str) -> _ResolvedPlan | None:
+    """Находит тариф в каталоге и собирает общие для обоих способов оплаты поля.
+
+    Планы вне статичных таблиц (``record is None``) берутся только из БД.
+    """
+    plan_obj = (await _get_catalog()).by_name.get(plan_id)
+    if plan_obj is None:
+        return None
+    record = _PLAN_TABLE.get(plan_id)
+    display_name = plan_obj.display_name or (record.title if record and record.title else plan_obj.name.upper())
+    description = plan_obj.description or (record.description if record else "")
+    return _ResolvedPlan(plan_obj, record, display_name, description)
+
+
+# Одновременно создаваемые инвойсы/платежи ЮКассы: ограничиваем, чтобы всплеск
+# нажатий не занимал весь пул потоков и соединения к БД и API
+PAYMENT_CALLBACK_CONCURRENCY = 20
+_PAYMENT_SEM = asyncio.Semaphore(PAYMENT_CALLBACK_CONCURRENCY)
+
+
+def _limit_payment_concurrency(func):
+    """Пропускает вызов через _PAYMENT_SEM, откуда бы ни пришло нажатие кнопки."""
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        async with _PAYMENT_SEM:
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+@_limit_payment_concurrency
 async def initiate_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, plan_id: str) -> None:
     """Инициирует процесс оплаты для выбранного плана."""
     try:
-        logger.info(f"Инициируем оплату для плана: {plan_id}")
+        logger.info("Инициируем оплату для плана: %s", plan_id)
         log_step(update, "payments:initiate", {"plan": plan_id})
 
-        enum_value = None
-        try:
-            enum_value = getattr(PlanType, plan_id.upper())
-        except AttributeError:
-            enum_value = None
-
-        pass #session = SessionLocal()
-        try:
-            plan_obj = session.query(Plan).filter(Plan.name == (enum_value.value if enum_value else plan_id)).first()
-        finally:
-            session.close()
-
-        if not plan_obj:
-            logger.warning(f"План не найден: {plan_id}")
+        resolved = await _resolve_plan(plan_id)
+        if resolved is None:
+            logger.warning("План не найден: %s", plan_id)
             await update.callback_query.edit_message_text("❌ Тариф временно недоступен")
             return
+        plan_obj, display_name, description = resolved.plan, resolved.display_name, resolved.description
 
-        stars_price = _get_stars_price(plan_obj, enum_value)
+        stars_price = _get_stars_price(plan_obj, resolved.record)
         if not stars_price:
-            logger.warning(f"План {plan_id} недоступен для оплаты Stars")
+            logger.warning("План %s недоступен для оплаты Stars", plan_id)
             await update.callback_query.edit_message_text("❌ Этот план недоступен для оплаты через Telegram Stars")
             return
 
-        meta = _resolve_plan_meta(enum_value, plan_obj.name)
-        display_name = plan_obj.display_name or meta.get("title", plan_obj.name.upper())
-        description = meta.get("description", "")
-        if plan_obj.description:
-            description = plan_obj.description
-
         # Создаем invoice для оплаты через Telegram Stars
         prices = [LabeledPrice(label=f"План {display_name}", amount=stars_price)]
 
@@ -254,133 +446,263 @@ async def initiate_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, p
             chat_id=update.effective_chat.id,
             title=f"Подписка {display_name} - CyberKitty Transkribator",
             description=description or f"Тариф {display_name} в CyberKitty Transkribator",
-            payload=f"plan_{plan_id}",
+            payload=f"{_PAYLOAD_PREFIX}{plan_id}",
             provider_token="",  # Для Telegram Stars оставляем пустым
             currency="XTR",  # XTR - это код для Telegram Stars
             prices=prices,
             start_parameter="subscription"
         )
 
-        logger.info(f"Invoice для плана {plan_id} отправлен пользователю {update.effective_user.id}")
+        logger.info("Invoice для плана %s отправлен пользователю %s", plan_id, update.effective_user.id)
 
     except Exception as e:
-        logger.error(f"Ошибка при инициации платежа: {e}")
+        logger.exception("Ошибка при инициации платежа: %s", e)
         await update.callback_query.edit_message_text("❌ Ошибка при создании платежа")
 
+@_limit_payment_concurrency
 async def initiate_yukassa_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, plan_id: str) -> None:
     """Инициирует процесс оплаты через ЮКассу для выбранного плана."""
     try:
-        logger.info(f"Инициируем оплату через ЮКассу для плана: {plan_id}")
+        logger.info("Инициируем оплату через ЮКассу для плана: %s", plan_id)
         log_step(update, "payments:yukassa_init", {"plan": plan_id})
 
-        # Разрешаем планы, отсутствующие в enum, используя БД как источник истины
-        enum_value = None
-        plan_type = None
-        try:
-            plan_type = getattr(PlanType, plan_id.upper())
-            enum_value = plan_type
-        except AttributeError:
-            plan_type = None  # DB-only plan (e.g., unlimited_year)
-
-        pass #session = SessionLocal()
-        try:
-            plan_obj = session.query(Plan).filter(Plan.name == (plan_type.value if plan_type else plan_id)).first()
-        finally:
-            session.close()
-
-        if not plan_obj:
-            logger.warning(f"План не найден в БД: {plan_id}")
+        resolved = await _resolve_plan(plan_id)
+        if resolved is None:
+            logger.warning("План не найден в БД: %s", plan_id)
             await update.callback_query.edit_message_text(f"❌ Неизвестный тарифный план: {plan_id}")
             return
+        plan_obj, display_name, description = resolved.plan, resolved.display_name, resolved.description
 
-        rub_price = float(plan_obj.price_rub or 0.0) if plan_obj else float(PLAN_PRICES_RUB.get(enum_value, 0.0))
+        # Та же функция, что решает, показывать ли кнопку ЮКассы в списке тарифов
+        rub_price = _get_rub_price(plan_obj, resolved.record) or 0.0
         if rub_price <= 0:
-            logger.warning(f"План {plan_id} недоступен для ЮКассы (price_rub <= 0)")
+            logger.warning("План %s недоступен для ЮКассы (price_rub <= 0)", plan_id)
             await update.callback_query.edit_message_text("❌ Этот план недоступен для оплаты через ЮКассу")
             return
 
-        meta = PLAN_DESCRIPTIONS.get(enum_value, {}) if enum_value else {}
-        display_name = plan_obj.display_name if plan_obj else meta.get("title", (plan_type.value if plan_type else plan_id).upper())
-        description = (plan_obj.description or meta.get("description", "")) if plan_obj else meta.get("description", "")
-
         plan_display_price = f"{rub_price:.0f} ₽"
 
         # Создаем платеж через ЮКассу
         try:
-            yukassa_service = YukassaPaymentService()
-            payment_result = yukassa_service.create_payment(
+            yukassa_service = get_yukassa_service()
+            # SDK ЮКассы синхронный: HTTP-запрос выполняем вне event loop
+            payment_result = await asyncio.to_thread(
+                yukassa_service.create_payment,
                 user_id=update.effective_user.id,
-                plan_type=(plan_type.value if plan_type else plan_id),
+                plan_type=plan_obj.name,
                 amount=rub_price,
                 description=f"Подписка {display_name} - CyberKitty Transkribator"
             )
 
             # Отправляем ссылку на оплату
-            payment_text = f"""💳 **Оплата через ЮКассу**
-
-📦 **План:** {display_name}
-💰 **Сумма:** {plan_display_price}
-📝 **Описание:** {description or 'Подписка CyberKitty Transkribator'}
-
-🔗 **Ссылка для оплаты:**
-{payment_result['confirmation_url']}
-
-⚠️ **Важно:** После успешной оплаты ваша подписка будет активирована автоматически.
-
-💡 Если у вас возникли проблемы с оплатой, обратитесь в поддержку."""
+            payment_text = _YUKASSA_TMPL.format_map({
+                "plan": display_name,
+                "price": plan_display_price,
+                "description": description or "Подписка CyberKitty Transkribator",
+            })
 
-            keyboard = [
+            reply_markup = InlineKeyboardMarkup([
                 [InlineKeyboardButton("💳 Перейти к оплате", url=payment_result['confirmation_url'])],
-                [InlineKeyboardButton("🔙 Назад к тарифам", callback_data="show_payment_plans")]
-            ]
+                _BACK_TO_PLANS_ROW,
+            ])
 
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            await update.callback_query.edit_message_text(
-                payment_text,
-                reply_markup=reply_markup,
-                parse_mode='Markdown'
-            )
+            await update.callback_query.edit_message_text(payment_text, reply_markup=reply_markup)
 
-            logger.info(f"Платеж ЮКассы для плана {plan_id} создан: {payment_result['payment_id']}")
+            logger.info("Платеж ЮКассы для плана %s создан: %s", plan_id, payment_result['payment_id'])
             log_step(update, "payments:yukassa_link_sent", {
                 "plan": plan_id,
                 "payment_id": payment_result['payment_id'],
             })
 
         except Exception as yukassa_error:
-            logger.error(f"Ошибка создания платежа ЮКассы: {yukassa_error}")
+            logger.exception("Ошибка создания платежа ЮКассы: %s", yukassa_error)
             log_step(update, "payments:yukassa_error", {"plan": plan_id, "error": str(yukassa_error)})
             await update.callback_query.edit_message_text(
                 "❌ Ошибка при создании платежа через ЮКассу. Попробуйте оплатить через Telegram Stars."
             )
 
     except Exception as e:
-        logger.error(f"Ошибка при инициации платежа ЮКассы: {e}")
+        logger.exception("Ошибка при инициации платежа ЮКассы: %s", e)
         log_step(update, "payments:yukassa_error", {"plan": plan_id, "error": str(e)})
         await update.callback_query.edit_message_text("❌ Ошибка при создании платежа")
 
-async def handle_pre_checkout_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Обрабатывает pre-checkout запросы."""
-    try:
-        query = update.pre_checkout_query
-        
-        log_step(update, "payments:pre_checkout", {
-            "invoice_payload": query.invoice_payload,
-            "total_amount": query.total_amount,
-            "currency": query.currency,
-        })
+async def _is_known_payload(payload: str | None) -> bool:
+    """Проверяет, что payload имеет вид ``plan_<id>`` и ссылается на известный тариф.
 
-        # Здесь можно добавить дополнительные проверки
-        # Например, проверить доступность товара, валидность цены и т.д.
+    Формат проверяется до любой другой работы. Тарифы вне статичной таблицы
+    ищутся в каталоге ``_get_catalog``: он кеширован, а после рестарта или
+    истечения TTL перечитывается из БД в пуле потоков.
+    """
+    if not payload or len(payload) > _PAYLOAD_MAX_LEN or not payload.startswith(_PAYLOAD_PREFIX):
+        return False
+    plan_id = payload[len(_PAYLOAD_PREFIX):]
+    if plan_id in _PLAN_TABLE:
+        return True
+    return plan_id in (await _get_catalog()).by_name
 
-        await query.answer(ok=True)
-        logger.info(f"Pre-checkout query одобрен для пользователя {query.from_user.id}")
 
+async def handle_pre_checkout_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Обрабатывает pre-checkout запросы.
+
+    Telegram ждёт ответа ограниченное время, поэтому сначала отвечаем,
+    а логирование выполняем уже после подтверждения.
+    """
+    query = update.pre_checkout_query
+    try:
+        # Сначала дешёвая проверка формата; к БД идём только за тарифами вне статичной таблицы
+        if not await _is_known_payload(query.invoice_payload):
+            await query.answer(ok=False, error_message="Неверный формат платежа")
+            logger.warning("Отклонён pre-checkout с неизвестным payload от пользователя %s", query.from_user.id)
+            log_step(update, "payments:pre_checkout_rejected", {"invoice_payload": query.invoice_payload[:64]})
+            return
+        await query.answer(ok=True)
     except Exception as e:
-        logger.error(f"Ошибка в pre-checkout query: {e}")
-        log_step(update, "payments:pre_checkout_error", {"error": str(e)})
+        # Сначала отказ Telegram (срок ответа ограничен), затем логирование
         await query.answer(ok=False, error_message="Произошла ошибка при обработке платежа")
+        logger.exception("Ошибка в pre-checkout query: %s", e)
+        log_step(update, "payments:pre_checkout_error", {"error": str(e)})
+        return
+
+    logger.info("Pre-checkout query одобрен для пользователя %s", query.from_user.id)
+    log_step(update, "payments:pre_checkout", {
+        "invoice_payload": query.invoice_payload,
+        "total_amount": query.total_amount,
+        "currency": query.currency,
+    })
+
+
+# Результаты сохранения платежа
+_PAYMENT_APPLIED = "applied"
+_PAYMENT_DUPLICATE = "duplicate"
+_PAYMENT_UPGRADE_FAILED = "upgrade_failed"
+
+
+def _apply_payment(user_service: UserService, transaction_service: TransactionService,
+                   user_id: int, plan_name: str, payment) -> str:
+    """Записывает пользователя, платеж и апгрейд в сессию сервисов без коммита.
+
+    Запись о платеже сохраняется в любом случае: если план обновить не удалось,
+    транзакция помечается статусом ``upgrade_failed`` для ручной активации.
+    Блокировку плана пользователя заранее берёт ``_persist_payment_batch``.
+    """
+    currency = payment.currency
+    is_stars = currency == "XTR"
+    amount_rub = payment.total_amount / 100 if currency == "RUB" else 0.0
+    amount_stars = payment.total_amount if is_stars else 0
+
+    # Платеж приходит от пользователя бота, так что строка почти всегда уже есть
+    db_user = user_service.get_user_by_telegram_id(user_id)
+    if db_user is None:
+        db_user = user_service.get_or_create_user(telegram_id=user_id, commit=False)
+    logger.info("Определен план для пользователя %s: %s", user_id, plan_name)
+
+    transaction = transaction_service.create_transaction(
+        user=db_user,
+        plan_type=plan_name,
+        amount_rub=amount_rub,
+        amount_stars=amount_stars,
+        payment_method="telegram_stars" if is_stars else "telegram_payments",
+        currency=currency,
+        provider_payment_charge_id=payment.provider_payment_charge_id,
+        telegram_payment_charge_id=payment.telegram_payment_charge_id,
+        commit=False,
+    )
+
+    if not user_service.upgrade_user_plan(db_user, plan_name, commit=False):
+        # Деньги уже списаны: запись о платеже не откатываем, а помечаем
+        transaction.status = _PAYMENT_UPGRADE_FAILED
+        user_service.db.flush()
+        return _PAYMENT_UPGRADE_FAILED
+    return _PAYMENT_APPLIED
+
+
+def _apply_payment_isolated(db, user_service: UserService, transaction_service: TransactionService,
+                            user_id: int, plan_name: str, payment) -> str | Exception:
+    """Применяет один платеж в своём SAVEPOINT.
+
+    Дубликатом считается только нарушение уникальности, после которого charge id
+    действительно найден в БД. Другое нарушение (например, гонка при создании
+    строки users) повторяется один раз в новом SAVEPOINT.
+    """
+    error: Exception | None = None
+    for _attempt in range(2):
+        try:
+            with db.begin_nested():
+                return _apply_payment(user_service, transaction_service, user_id, plan_name, payment)
+        except IntegrityError as e:
+            if transaction_service.exists_by_telegram_charge_id(payment.telegram_payment_charge_id):
+                return _PAYMENT_DUPLICATE
+            error = e
+        except Exception as e:
+            return e
+    return error
+
+
+def _persist_payment_batch(items: list[tuple]) -> list:
+    """Сохраняет пачку платежей одним коммитом.
+
+    Каждый платеж пишется в своём SAVEPOINT: дубликат или ошибка откатывают
+    только его, остальные фиксируются общим коммитом при выходе из ``SessionLocal.begin()``.
+    Для каждого элемента возвращает результат ``_apply_payment``,
+    ``_PAYMENT_DUPLICATE`` (платеж с таким ``telegram_payment_charge_id`` уже
+    сохранён) или исключение.
+    Вызывается через ``asyncio.to_thread``.
+    """
+    results: list = []
+    with SessionLocal.begin() as db:
+        # Сервисы только держат сессию — создаём их один раз на пачку
+        user_service = UserService(db)
+        transaction_service = TransactionService(db)
+        # Блокировки всех пользователей пачки держатся до общего коммита, поэтому
+        # берём их заранее и в одном порядке: иначе две пачки с пересекающимися
+        # пользователями могут взаимно заблокироваться
+        user_service.lock_user_plans(user_id for user_id, _, _ in items)
+        for user_id, plan_name, payment in items:
+            results.append(
+                _apply_payment_isolated(db, user_service, transaction_service, user_id, plan_name, payment)
+            )
+    return results
+
+
+_PAYMENT_BATCH_MAX = 100
+_payment_queue: asyncio.Queue | None = None
+_payment_flusher: asyncio.Task | None = None
+
+
+async def _flush_payments() -> None:
+    """Фоновая задача: забирает накопившиеся платежи и сохраняет их пачкой."""
+    while True:
+        batch = [await _payment_queue.get()]
+        # Не ждём добора пачки: одиночный платеж сохраняется сразу,
+        # а при всплеске в пачку попадает всё, что уже стоит в очереди
+        while len(batch) < _PAYMENT_BATCH_MAX and not _payment_queue.empty():
+            batch.append(_payment_queue.get_nowait())
+
+        try:
+            results = await asyncio.to_thread(_persist_payment_batch, [item[:3] for item in batch])
+        except Exception as e:
+            results = [e] * len(batch)
+
+        for (*_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+async def _persist_payment(user_id: int, plan_name: str, payment) -> str:
+    """Ставит платеж в очередь пакетной записи и ждёт результата его сохранения."""
+    global _payment_queue, _payment_flusher
+    if _payment_queue is None:
+        _payment_queue = asyncio.Queue()
+    if _payment_flusher is None or _payment_flusher.done():
+        _payment_flusher = asyncio.create_task(_flush_payments())
+
+    future = asyncio.get_running_loop().create_future()
+    await _payment_queue.put((user_id, plan_name, payment, future))
+    return await future
 
 
 async def handle_successful_payment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -388,88 +710,98 @@ async def handle_successful_payment(update: Update, context: ContextTypes.DEFAUL
     try:
         payment = update.message.successful_payment
         user_id = update.effective_user.id
+        charge_id = payment.telegram_payment_charge_id
+
+        if not _claim_charge(charge_id):
+            logger.info("Повторная доставка платежа %s от пользователя %s, пропускаем", charge_id, user_id)
+            log_step(update, "payments:success_duplicate", {"telegram_charge_id": charge_id})
+            return
+
+        currency = payment.currency
+        total = payment.total_amount
+        display_amount = total / 100 if currency == "RUB" else total
+        payload = payment.invoice_payload
+
+        logger.info("Успешный платеж от пользователя %s: %s %s", user_id, display_amount, currency)
 
-        logger.info(f"Успешный платеж от пользователя {user_id}: {payment.total_amount/100 if payment.currency == 'RUB' else payment.total_amount} {payment.currency}")
-        
         # Определяем план по payload
-        plan_name = payment.invoice_payload.replace("plan_", "") if payment.invoice_payload.startswith("plan_") else "pro"
-        
+        plan_name = payload.removeprefix(_PAYLOAD_PREFIX) if payload.startswith(_PAYLOAD_PREFIX) else "pro"
+
         log_step(update, "payments:success", {
             "plan": plan_name,
-            "amount": payment.total_amount,
-            "currency": payment.currency,
+            "amount": total,
+            "currency": currency,
             "provider": payment.provider_payment_charge_id,
-            "telegram_charge_id": payment.telegram_payment_charge_id,
+            "telegram_charge_id": charge_id,
         })
 
-        # Обновляем подписку пользователя в базе данных
-        pass #db = SessionLocal()
-        db = SessionLocal()
+        # Запись идёт пачками в пуле потоков, чтобы не блокировать event loop;
+        # пользователю отвечаем только после фиксации платежа в БД
         try:
-            user_service = UserService(db)
-            transaction_service = TransactionService(db)
-
-            # Получаем пользователя
-            db_user = user_service.get_or_create_user(telegram_id=user_id)
-
-            logger.info(f"Определен план для пользователя {user_id}: {plan_name}")
-
-            # Создаем транзакцию
-            amount_rub = payment.total_amount / 100 if payment.currency == "RUB" else None
-            amount_stars = payment.total_amount if payment.currency == "XTR" else None
-
-            transaction = transaction_service.create_transaction(
-                user=db_user,
-                plan_type=plan_name,
-                amount_rub=amount_rub or 0.0,
-                amount_stars=amount_stars or 0,
-                payment_method="telegram_stars" if payment.currency == "XTR" else "telegram_payments",
-                currency=payment.currency,
-                provider_payment_charge_id=payment.provider_payment_charge_id,
-                telegram_payment_charge_id=payment.telegram_payment_charge_id,
-            )
-
-            # Обновляем план пользователя
-            upgrade_success = user_service.upgrade_user_plan(db_user, plan_name)
-            if upgrade_success:
-                logger.info(f"Подписка пользователя {user_id} успешно обновлена до плана {plan_name}")
-            else:
-                logger.error(f"Ошибка при обновлении плана пользователя {user_id} до {plan_name}")
-
+            outcome = await _persist_payment(user_id, plan_name, payment)
         except Exception as e:
-            logger.error(f"Ошибка при обновлении подписки: {e}")
-        finally:
-            db.close()
+            _PROCESSED_CHARGES.pop(charge_id, None)
+            logger.exception("Не удалось сохранить платеж %s пользователя %s: %s", charge_id, user_id, e)
+            log_step(update, "payments:persist_error", {"telegram_charge_id": charge_id, "error": str(e)})
+            await _reply(update, context, _ACTIVATION_FAILED_TMPL.format_map({"charge_id": charge_id}))
+            return
 
-        success_text = f"""🎉 Платеж успешно обработан!
+        if outcome == _PAYMENT_DUPLICATE:
+            # Уникальный индекс по telegram_payment_charge_id: платеж уже учтён ранее
+            logger.info("Платеж %s уже сохранён в БД, пропускаем повторную доставку", charge_id)
+            log_step(update, "payments:success_duplicate", {"telegram_charge_id": charge_id})
+            return
+        if outcome == _PAYMENT_UPGRADE_FAILED:
+            logger.error(
+                "Платеж %s пользователя %s сохранён, но план %s не активирован",
+                charge_id, user_id, plan_name,
+            )
+            log_step(update, "payments:upgrade_failed", {"plan": plan_name, "telegram_charge_id": charge_id})
+            await _reply(update, context, _ACTIVATION_FAILED_TMPL.format_map({"charge_id": charge_id}))
+            return
+        logger.info("Подписка пользователя %s успешно обновлена до плана %s", user_id, plan_name)
 
-💳 Сумма: {payment.total_amount/100 if payment.currency == 'RUB' else payment.total_amount} {payment.currency}
-📦 Товар: {payment.invoice_payload}
-🎯 ID транзакции: {payment.telegram_payment_charge_id}
+        success_text = _SUCCESS_TMPL.format_map({
+            "amount": display_amount,
+            "currency": currency,
+            "payload": payload,
+            "charge_id": charge_id,
+        })
 
-✅ Ваша подписка активирована!
+        await _reply(update, context, success_text, reply_markup=_SUCCESS_MARKUP)
+        log_step(update, "payments:success_delivered", {"plan": plan_name})
 
-Что теперь доступно:
-• Увеличенные лимиты транскрипции
-• Приоритетная обработка файлов
-• Расширенная техническая поддержка
-• Дополнительные функции ИИ
+    except Exception as e:
+        logger.exception("Ошибка при обработке успешного платежа: %s", e)
+        log_step(update, "payments:success_error", {"error": str(e)})
+        await _reply(update, context, "❌ Произошла ошибка при активации подписки")
 
-Спасибо за использование CyberKitty Transkribator! 🐱✨"""
+async def _stay_basic(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    log_step(update, "payments:stay_basic")
+    await update.callback_query.edit_message_text(
+        "👍 Вы остаетесь на базовом тарифе!\n\n"
+        "В любой момент можете перейти на PRO или UNLIMITED план "
+        "для расширения возможностей. 🚀"
+    )
 
-        keyboard = [
-            [InlineKeyboardButton("🏠 Личный кабинет", callback_data="personal_cabinet")]
-        ]
 
-        reply_markup = InlineKeyboardMarkup(keyboard)
+def _build_callback_handlers() -> dict[str, tuple]:
+    """Собирает таблицу callback_data -> (обработчик, plan_id) при импорте модуля."""
+    handlers: dict[str, tuple] = {
+        "show_payment_plans": (show_payment_plans, None),
+        "stay_basic": (_stay_basic, None),
+    }
+    for plan_id, (stars_data, yukassa_data) in _BUY_CALLBACKS.items():
+        # Без суффикса — старый формат кнопок (Stars)
+        handlers[f"buy_plan_{plan_id}"] = (initiate_payment, plan_id)
+        handlers[stars_data] = (initiate_payment, plan_id)
+        handlers[yukassa_data] = (initiate_yukassa_payment, plan_id)
+    return handlers
 
-        await _reply(update, context, success_text, reply_markup=reply_markup)
-        log_step(update, "payments:success_delivered", {"plan": plan_name})
 
-    except Exception as e:
-        logger.error(f"Ошибка при обработке успешного платежа: {e}")
-        log_step(update, "payments:success_error", {"error": str(e)})
-        await _reply(update, context, "❌ Произошла ошибка при активации подписки")
+_CALLBACK_HANDLERS = _build_callback_handlers()
+
+_BUY_PLAN_PREFIX = "buy_plan_"
 
 async def handle_payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает колбеки связанные с платежами."""
@@ -480,32 +812,47 @@ async def handle_payment_callback(update: Update, context: ContextTypes.DEFAULT_
         # Логируем payment callback
         log_step(update, "payments:callback", {"data": data})
 
-        if data == "show_payment_plans":
-            await show_payment_plans(update, context)
-        elif data.startswith("buy_plan_"):
-            if data.endswith("_stars"):
-                # Платеж через Telegram Stars
-                plan_id = data.replace("buy_plan_", "").replace("_stars", "")
-                await initiate_payment(update, context, plan_id)
-            elif data.endswith("_yukassa"):
-                # Платеж через ЮКассу
-                plan_id = data.replace("buy_plan_", "").replace("_yukassa", "")
-                await initiate_yukassa_payment(update, context, plan_id)
+        entry = _CALLBACK_HANDLERS.get(data)
+        if entry is not None:
+            handler, plan_id = entry
+            if plan_id is None:
+                await handler(update, context)
             else:
-                # Старый формат для обратной совместимости
-                plan_id = data.replace("buy_plan_", "")
-                await initiate_payment(update, context, plan_id)
-        elif data == "stay_basic":
-            log_step(update, "payments:stay_basic")
-            await query.edit_message_text(
-                "👍 Вы остаетесь на базовом тарифе!\n\n"
-                "В любой момент можете перейти на PRO или UNLIMITED план "
-                "для расширения возможностей. 🚀"
-            )
-        else:
-            await query.edit_message_text("Неизвестная команда платежной системы")
+                await handler(update, context, plan_id)
+            return
+
+        # Запасной разбор для планов, которые есть только в БД:
+        # buy_plan_<plan>[_stars|_yukassa]
+        if data.startswith(_BUY_PLAN_PREFIX):
+            plan_id = data.removeprefix(_BUY_PLAN_PREFIX)
+            if plan_id.endswith("_yukassa"):
+                initiate, plan_id = initiate_yukassa_payment, plan_id.removesuffix("_yukassa")
+            else:
+                initiate, plan_id = initiate_payment, plan_id.removesuffix("_stars")
+            if plan_id:
+                await initiate(update, context, plan_id)
+                return
+
+        await query.edit_message_text("Неизвестная команда платежной системы")
 
     except Exception as e:
-        logger.error(f"Ошибка в payment callback: {e}")
+        logger.exception("Ошибка в payment callback: %s", e)
         log_step(update, "payments:callback_error", {"error": str(e)})
         await query.edit_message_text("❌ Ошибка при обработке запроса")
+
+
+__all__ = [
+    "PLAN_PRICES_STARS",
+    "PLAN_PRICES_RUB",
+    "PLAN_DESCRIPTIONS",
+    "PLAN_DESCRIPTIONS_EXTRA",
+    "UNLIMITED_YEAR_PLAN",
+    "EXCLUDED_PLAN_TYPES",
+    "PlanRecord",
+    "show_payment_plans",
+    "initiate_payment",
+    "initiate_yukassa_payment",
+    "handle_pre_checkout_query",
+    "handle_successful_payment",
+    "handle_payment_callback",
+]
@@ -2,23 +2,122 @@
 Webhook обработчик для ЮКассы
 """
 
+import asyncio
+import ipaddress
 import json
 from typing import Dict, Any
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import JSONResponse
+from sqlalchemy.exc import IntegrityError
 
-from transkribator_modules.config import logger
-from transkribator_modules.payments.yukassa import YukassaPaymentService
+from transkribator_modules.config import logger, YUKASSA_WEBHOOK_IP_CHECK
+from transkribator_modules.payments.yukassa import get_yukassa_service
 from transkribator_modules.db.database import SessionLocal, UserService, TransactionService
 from transkribator_modules.payments.monitoring import record_yukassa_webhook_status
 
 
+# Сети, с которых ЮКасса отправляет уведомления (документация ЮКассы, раздел «Входящие уведомления»)
+_YUKASSA_NETWORKS = tuple(
+    ipaddress.ip_network(net)
+    for net in (
+        "185.71.76.0/27",
+        "185.71.77.0/27",
+        "77.75.153.0/25",
+        "77.75.156.11/32",
+        "77.75.156.35/32",
+        "77.75.154.128/25",
+        "2a02:5180::/32",
+    )
+)
+
+
+def _is_yukassa_address(host: str | None) -> bool:
+    if not host:
+        return False
+    try:
+        addr = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(addr in net for net in _YUKASSA_NETWORKS)
+
+
+def _duplicate_response(payment_id: str, user_id: int) -> JSONResponse:
+    logger.info("Повторный webhook ЮКассы для платежа %s, пропускаем", payment_id)
+    record_yukassa_webhook_status(
+        "duplicate",
+        {
+            "payment_id": payment_id,
+            "user_id": user_id,
+        },
+    )
+    return JSONResponse(content={"status": "duplicate"})
+
+
+def _persist_yukassa_payment(user_id: int, plan_type: str, amount: float, payment_id: str) -> bool:
+    """Сохраняет платеж ЮКассы и обновляет план пользователя одной транзакцией.
+
+    Пользователь, запись о платеже и апгрейд фиксируются одним коммитом. Возвращает
+    ``False``, если платеж с таким ``payment_id`` уже сохранён. Вызывается через
+    ``asyncio.to_thread``.
+    """
+    try:
+        with SessionLocal.begin() as db:
+            user_service = UserService(db)
+            transaction_service = TransactionService(db)
+
+            # Параллельные оплаты одного пользователя применяем по очереди;
+            # повторная доставка после ожидания увидит уже записанный платеж
+            user_service.lock_user_plan(user_id)
+
+            # ЮКасса доставляет webhook как минимум один раз: повтор с тем же
+            # payment_id не должен второй раз продлевать подписку
+            if transaction_service.exists_by_external_id(payment_id):
+                return False
+
+            # Платеж создаётся из бота, так что пользователь почти всегда уже есть:
+            # обычный SELECT без служебного UPDATE из get_or_create_user
+            db_user = user_service.get_user_by_telegram_id(user_id)
+            if db_user is None:
+                db_user = user_service.get_or_create_user(telegram_id=user_id, commit=False)
+
+            transaction_service.create_transaction(
+                user=db_user,
+                plan_type=plan_type,
+                amount_rub=amount,
+                amount_stars=0,
+                payment_method="yukassa",
+                currency="RUB",
+                external_payment_id=payment_id,
+                commit=False,
+            )
+
+            # При ошибке апгрейда откатываем и запись о платеже,
+            # ЮКасса повторит webhook после ответа 500
+            if not user_service.upgrade_user_plan(db_user, plan_type, commit=False):
+                raise RuntimeError(f"не удалось обновить план до {plan_type}")
+    except IntegrityError:
+        # Дубликат, только если параллельная доставка действительно записала этот
+        # платеж; иное нарушение уникальности — ошибка, ЮКасса повторит webhook
+        with SessionLocal() as db:
+            if TransactionService(db).exists_by_external_id(payment_id):
+                return False
+        raise
+    return True
+
+
 async def handle_yukassa_webhook(request: Request) -> JSONResponse:
     """Обрабатывает webhook от ЮКассы"""
     try:
+        # Источник проверяем до чтения и разбора тела: чужие запросы не стоят ни парсинга, ни записи статуса
+        if YUKASSA_WEBHOOK_IP_CHECK:
+            host = request.client.host if request.client else None
+            if not _is_yukassa_address(host):
+                logger.warning("Webhook ЮКассы отклонён: адрес %s вне сетей ЮКассы", host)
+                return JSONResponse(content={"status": "forbidden"}, status_code=403)
+
         # Получаем данные webhook
         webhook_data = await request.json()
-        logger.info(f"Получен webhook от ЮКассы: {webhook_data}")
+        logger.info("Получен webhook от ЮКассы: %s", webhook_data)
         record_yukassa_webhook_status(
             "received",
             {
@@ -27,11 +126,26 @@ async def handle_yukassa_webhook(request: Request) -> JSONResponse:
             },
         )
 
-        # Создаем сервис ЮКассы
-        yukassa_service = YukassaPaymentService()
+        # Общий экземпляр сервиса: конфигурация SDK выполняется один раз на процесс
+        yukassa_service = get_yukassa_service()
+
+        # process_webhook сверяет платеж синхронным запросом к API ЮКассы —
+        # выполняем его в пуле потоков, чтобы не блокировать event loop
+        # Тело webhook как запасной источник данных допустимо только для
+        # адресов, уже проверенных по сетям ЮКассы
+        payment_info = await asyncio.to_thread(
+            yukassa_service.process_webhook,
+            webhook_data,
+            allow_body_fallback=YUKASSA_WEBHOOK_IP_CHECK,
+        )
 
-        # Обрабатываем webhook
-        payment_info = yukassa_service.process_webhook(webhook_data)
+        if not payment_info and webhook_data.get("event") == "payment.succeeded":
+            # Платеж не подтверждён API ЮКассы: не 200, чтобы ЮКасса повторила доставку
+            record_yukassa_webhook_status(
+                "unverified",
+                {"object_id": webhook_data.get("object", {}).get("id")},
+            )
+            return JSONResponse(content={"status": "unverified"}, status_code=503)
 
         if not payment_info:
             logger.info("Webhook не требует обработки")
@@ -71,35 +185,17 @@ async def handle_yukassa_webhook(request: Request) -> JSONResponse:
                 status_code=400,
             )
 
-        logger.info(f"Обрабатываем успешный платеж {payment_id} от пользователя {user_id}")
+        logger.info("Обрабатываем успешный платеж %s от пользователя %s", payment_id, user_id)
 
-        # Обновляем подписку пользователя в базе данных
-        db = SessionLocal()
+        # Синхронная работа с БД выполняется в пуле потоков, чтобы не блокировать event loop
         try:
-            user_service = UserService(db)
-            transaction_service = TransactionService(db)
-
-            # Получаем пользователя
-            db_user = user_service.get_or_create_user(telegram_id=user_id)
-
-            # Создаем транзакцию
-            transaction = transaction_service.create_transaction(
-                user=db_user,
-                plan_type=plan_type,
-                amount_rub=amount,
-                amount_stars=0,
-                payment_method="yukassa",
-                currency="RUB",
-                external_payment_id=payment_id,
+            persisted = await asyncio.to_thread(
+                _persist_yukassa_payment, user_id, plan_type, amount, payment_id
             )
+            if not persisted:
+                return _duplicate_response(payment_id, user_id)
 
-            # Обновляем план пользователя
-            upgrade_success = user_service.upgrade_user_plan(db_user, plan_type)
-            if upgrade_success:
-                logger.info(f"Подписка пользователя {user_id} успешно обновлена до плана {plan_type}")
-            else:
-                logger.error(f"Ошибка при обновлении плана пользователя {user_id} до {plan_type}")
-
+            logger.info("Подписка пользователя %s успешно обновлена до плана %s", user_id, plan_type)
             record_yukassa_webhook_status(
                 "success",
                 {
@@ -111,7 +207,7 @@ async def handle_yukassa_webhook(request: Request) -> JSONResponse:
             return JSONResponse(content={"status": "success"})
 
         except Exception as e:
-            logger.error(f"Ошибка при обработке платежа ЮКассы: {e}")
+            logger.exception("Ошибка при обработке платежа ЮКассы: %s", e)
             record_yukassa_webhook_status(
                 "error",
                 {
@@ -121,11 +217,9 @@ async def handle_yukassa_webhook(request: Request) -> JSONResponse:
                 },
             )
             return JSONResponse(content={"status": "error", "message": str(e)}, status_code=500)
-        finally:
-            db.close()
 
     except Exception as e:
-        logger.error(f"Ошибка при обработке webhook ЮКассы: {e}")
+        logger.exception("Ошибка при обработке webhook ЮКассы: %s", e)
         record_yukassa_webhook_status("error", {"exception": str(e)})
         return JSONResponse(content={"status": "error", "message": str(e)}, status_code=500)
 
@@ -1,7 +1,11 @@
 import os
 import sys
+import atexit
+import functools
 import logging
 import importlib
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 from typing import Any, Mapping, Optional
 
@@ -13,6 +17,28 @@ except ImportError:
     # dotenv не установлен, продолжаем без него
     pass
 
+# Снимок окружения (после load_dotenv): все настройки модуля читаются из него,
+# а не обращением к os.environ на каждую переменную
+_ENV: dict[str, str] = dict(os.environ)
+_TRUTHY = ('1', 'true', 'yes')
+
+
+def _env(name: str, default: Optional[str] = None) -> Optional[str]:
+    return _ENV.get(name, default)
+
+
+def _bool(name: str, default: str = 'false') -> bool:
+    return _env(name, default).lower() in _TRUTHY
+
+
+@functools.lru_cache(maxsize=None)
+def _ensure_dir(path: Path) -> Path:
+    """Создать каталог, если его нет; каждый путь проверяется один раз за процесс."""
+    if not path.is_dir():
+        path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
 # Определяем, запущены ли мы в контейнере
 IN_CONTAINER = os.path.exists('/app') and os.access('/app', os.W_OK)
 
@@ -21,32 +47,44 @@ if IN_CONTAINER:
     DATA_DIR = Path("/app/data")
 else:
     DATA_DIR = Path("./data")
-DATA_DIR.mkdir(parents=True, exist_ok=True)
+_ensure_dir(DATA_DIR)
 
 # Определяем окружение
-ENVIRONMENT = os.getenv('ENVIRONMENT', 'development').lower()
+ENVIRONMENT = _env('ENVIRONMENT', 'development').lower()
 
 # Настройка логирования
-LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
-logging.basicConfig(
-    level=getattr(logging, LOG_LEVEL.upper()),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
+# Вызывающий код только кладёт запись в очередь; запись в файл и stderr
+# выполняет фоновый поток QueueListener, не блокируя event loop.
+LOG_LEVEL = _env('LOG_LEVEL', 'INFO')
+if not logging.getLogger().handlers:
+    _log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    _log_handlers = [
         logging.FileHandler(DATA_DIR / 'bot.log'),
         logging.StreamHandler()
     ]
-)
+    for _handler in _log_handlers:
+        _handler.setFormatter(_log_formatter)
+
+    _log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    _queue_handler = QueueHandler(_log_queue)
+    # Сообщение форматируется целиком на стороне слушателя
+    _queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    _log_listener = QueueListener(_log_queue, *_log_handlers, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+    logging.basicConfig(level=getattr(logging, LOG_LEVEL.upper()), handlers=[_queue_handler])
 logger = logging.getLogger(__name__)
 
 # ===== ОСНОВНЫЕ НАСТРОЙКИ БОТА =====
 # Никогда не храните реальные токены в коде/репозитории.
 # Значение должно приходить из переменных окружения или .env (который игнорируется git).
-BOT_TOKEN = os.getenv('BOT_TOKEN', '')
+BOT_TOKEN = _env('BOT_TOKEN', '')
 
 # Проверяем BOT_TOKEN только для модулей бота (не для API сервера)
-_running_tests = 'PYTEST_CURRENT_TEST' in os.environ or any('pytest' in arg for arg in sys.argv)
+_running_tests = 'PYTEST_CURRENT_TEST' in _ENV or any('pytest' in arg for arg in sys.argv)
 default_require_bot_token = 'false' if _running_tests else 'true'
-REQUIRE_BOT_TOKEN = os.getenv('REQUIRE_BOT_TOKEN', default_require_bot_token).lower() == 'true'
+REQUIRE_BOT_TOKEN = _env('REQUIRE_BOT_TOKEN', default_require_bot_token).lower() == 'true'
 if REQUIRE_BOT_TOKEN and not BOT_TOKEN:
     logger.error("❌ BOT_TOKEN не установлен!")
     raise ValueError("BOT_TOKEN обязателен")
@@ -54,13 +92,16 @@ if not REQUIRE_BOT_TOKEN and not BOT_TOKEN and not _running_tests:
     logger.warning("⚠️ BOT_TOKEN отключён через REQUIRE_BOT_TOKEN=false — используйте только в тестах")
 
 # ===== TELEGRAM BOT API SERVER =====
-USE_LOCAL_BOT_API = os.getenv('USE_LOCAL_BOT_API', 'true').lower() == 'true'
-LOCAL_BOT_API_URL = os.getenv('LOCAL_BOT_API_URL', 'http://localhost:8083')
-LOCAL_BOT_FILE_API_URL = os.getenv('LOCAL_BOT_FILE_API_URL', 'http://localhost:8083')
+USE_LOCAL_BOT_API = _env('USE_LOCAL_BOT_API', 'true').lower() == 'true'
+LOCAL_BOT_API_URL = _env('LOCAL_BOT_API_URL', 'http://localhost:8083')
+LOCAL_BOT_FILE_API_URL = _env('LOCAL_BOT_FILE_API_URL', 'http://localhost:8083')
+# Размер пула HTTP-соединений к Bot API: длинные загрузки файлов не должны
+# занимать все соединения, нужные для коротких вызовов (инвойсы, ответы на колбеки)
+BOT_HTTP_POOL_SIZE = int(_env('BOT_HTTP_POOL_SIZE', '32'))
 
 # API_ID и API_HASH нужны только для Bot API Server (в docker-compose.yml)
-TELEGRAM_API_ID = int(os.getenv('TELEGRAM_API_ID', '0'))
-TELEGRAM_API_HASH = os.getenv('TELEGRAM_API_HASH', '')
+TELEGRAM_API_ID = int(_env('TELEGRAM_API_ID', '0'))
+TELEGRAM_API_HASH = _env('TELEGRAM_API_HASH', '')
 
 if USE_LOCAL_BOT_API:
     logger.info(f"🚀 Используется локальный Telegram Bot API Server: {LOCAL_BOT_API_URL}")
@@ -72,33 +113,36 @@ else:
     logger.info("🌐 Используется стандартный Telegram Bot API")
 
 # ===== API КЛЮЧИ ДЛЯ AI СЕРВИСОВ =====
-DEEPINFRA_API_KEY = os.getenv('DEEPINFRA_API_KEY', '')
-OPENROUTER_API_KEY = os.getenv('OPENROUTER_API_KEY', '')
-OPENROUTER_MODEL = os.getenv('OPENROUTER_MODEL', 'deepseek/deepseek-v4-flash')
-EMBEDDING_PROVIDER = os.getenv('EMBEDDING_PROVIDER', 'openrouter')
-EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'openai/text-embedding-3-small')
-EMBEDDING_TIMEOUT = float(os.getenv('EMBEDDING_TIMEOUT', '15'))
-DISABLE_REMOTE_EMBEDDINGS = os.getenv('DISABLE_REMOTE_EMBEDDINGS', 'false').lower() in ('1', 'true', 'yes')
+DEEPINFRA_API_KEY = _env('DEEPINFRA_API_KEY', '')
+OPENROUTER_API_KEY = _env('OPENROUTER_API_KEY', '')
+OPENROUTER_MODEL = _env('OPENROUTER_MODEL', 'deepseek/deepseek-v4-flash')
+EMBEDDING_PROVIDER = _env('EMBEDDING_PROVIDER', 'openrouter')
+EMBEDDING_MODEL = _env('EMBEDDING_MODEL', 'openai/text-embedding-3-small')
+EMBEDDING_TIMEOUT = float(_env('EMBEDDING_TIMEOUT', '15'))
+DISABLE_REMOTE_EMBEDDINGS = _bool('DISABLE_REMOTE_EMBEDDINGS', 'false')
 
 # ===== НАСТРОЙКИ ЮКАССЫ =====
-YUKASSA_SHOP_ID = os.getenv('YUKASSA_SHOP_ID', '')
-YUKASSA_SECRET_KEY = os.getenv('YUKASSA_SECRET_KEY', '')
-YUKASSA_DEFAULT_EMAIL = os.getenv('YUKASSA_DEFAULT_EMAIL', 'billing@transkribator.local')
-YUKASSA_VAT_CODE = int(os.getenv('YUKASSA_VAT_CODE', '1'))  # 1 = без НДС
-YUKASSA_TAX_SYSTEM_CODE = os.getenv('YUKASSA_TAX_SYSTEM_CODE')
+YUKASSA_SHOP_ID = _env('YUKASSA_SHOP_ID', '')
+YUKASSA_SECRET_KEY = _env('YUKASSA_SECRET_KEY', '')
+YUKASSA_DEFAULT_EMAIL = _env('YUKASSA_DEFAULT_EMAIL', 'billing@transkribator.local')
+YUKASSA_VAT_CODE = int(_env('YUKASSA_VAT_CODE', '1'))  # 1 = без НДС
+YUKASSA_TAX_SYSTEM_CODE = _env('YUKASSA_TAX_SYSTEM_CODE')
+# Отклонять webhook с адресов вне официальных сетей ЮКассы (за прокси нужен --proxy-headers).
+# Пока проверка выключена, платеж принимается только после подтверждения через API ЮКассы.
+YUKASSA_WEBHOOK_IP_CHECK = _bool('YUKASSA_WEBHOOK_IP_CHECK', 'false')
 
 # ===== НАСТРОЙКИ БАЗЫ ДАННЫХ =====
 if IN_CONTAINER:
-    DATABASE_URL = os.getenv('DATABASE_URL', f'sqlite:///{DATA_DIR}/cyberkitty19_transkribator.db')
+    DATABASE_URL = _env('DATABASE_URL', f'sqlite:///{DATA_DIR}/cyberkitty19_transkribator.db')
 else:
-    DATABASE_URL = os.getenv('DATABASE_URL', f'sqlite:///{DATA_DIR.absolute()}/cyberkitty19_transkribator.db')
+    DATABASE_URL = _env('DATABASE_URL', f'sqlite:///{DATA_DIR.absolute()}/cyberkitty19_transkribator.db')
 
 # ===== НАСТРОЙКИ ОБРАБОТКИ ФАЙЛОВ =====
-MAX_FILE_SIZE_MB = int(os.getenv('MAX_FILE_SIZE_MB', '2000'))
-MAX_AUDIO_DURATION_MINUTES = int(os.getenv('MAX_AUDIO_DURATION_MINUTES', '240'))
-ENABLE_LLM_FORMATTING = os.getenv('ENABLE_LLM_FORMATTING', 'true').lower() == 'true'
-ENABLE_SEGMENTATION = os.getenv('ENABLE_SEGMENTATION', 'true').lower() == 'true'
-SEGMENT_DURATION_SECONDS = int(os.getenv('SEGMENT_DURATION_SECONDS', '30'))
+MAX_FILE_SIZE_MB = int(_env('MAX_FILE_SIZE_MB', '2000'))
+MAX_AUDIO_DURATION_MINUTES = int(_env('MAX_AUDIO_DURATION_MINUTES', '240'))
+ENABLE_LLM_FORMATTING = _env('ENABLE_LLM_FORMATTING', 'true').lower() == 'true'
+ENABLE_SEGMENTATION = _env('ENABLE_SEGMENTATION', 'true').lower() == 'true'
+SEGMENT_DURATION_SECONDS = int(_env('SEGMENT_DURATION_SECONDS', '30'))
 
 # ===== ДИРЕКТОРИИ =====
 if IN_CONTAINER:
@@ -110,21 +154,21 @@ else:
     AUDIO_DIR = Path("./audio")
     TRANSCRIPTIONS_DIR = Path("./transcriptions")
 
-for directory in [VIDEOS_DIR, AUDIO_DIR, TRANSCRIPTIONS_DIR]:
-    directory.mkdir(parents=True, exist_ok=True)
+for directory in (VIDEOS_DIR, AUDIO_DIR, TRANSCRIPTIONS_DIR):
+    _ensure_dir(directory)
 
 # ===== ФИЧЕФЛАГИ И НОВЫЕ СЕРВИСЫ =====
-FEATURE_BETA_MODE = os.getenv('FEATURE_BETA_MODE', 'false').lower() == 'true'
-ROUTER_MODEL = os.getenv('ROUTER_MODEL', 'deepseek/deepseek-v4-flash')
-ROUTER_CONF_HIGH = float(os.getenv('ROUTER_CONF_HIGH', '0.80'))
-ROUTER_CONF_MID = float(os.getenv('ROUTER_CONF_MID', '0.55'))
-SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'pgvector')
-ENABLE_STRUCT_LOGS = os.getenv('ENABLE_STRUCT_LOGS', '0').lower() in ('1', 'true')
-FEATURE_GOOGLE_CALENDAR = os.getenv('FEATURE_GOOGLE_CALENDAR', 'true').lower() == 'true'
-GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID', '')
-GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET', '')
-GOOGLE_REDIRECT_URI = os.getenv('GOOGLE_REDIRECT_URI', '')
-GOOGLE_ENCRYPTION_KEY = os.getenv('GOOGLE_ENCRYPTION_KEY', '')
+FEATURE_BETA_MODE = _env('FEATURE_BETA_MODE', 'false').lower() == 'true'
+ROUTER_MODEL = _env('ROUTER_MODEL', 'deepseek/deepseek-v4-flash')
+ROUTER_CONF_HIGH = float(_env('ROUTER_CONF_HIGH', '0.80'))
+ROUTER_CONF_MID = float(_env('ROUTER_CONF_MID', '0.55'))
+SEARCH_BACKEND = _env('SEARCH_BACKEND', 'pgvector')
+ENABLE_STRUCT_LOGS = _env('ENABLE_STRUCT_LOGS', '0').lower() in ('1', 'true')
+FEATURE_GOOGLE_CALENDAR = _env('FEATURE_GOOGLE_CALENDAR', 'true').lower() == 'true'
+GOOGLE_CLIENT_ID = _env('GOOGLE_CLIENT_ID', '')
+GOOGLE_CLIENT_SECRET = _env('GOOGLE_CLIENT_SECRET', '')
+GOOGLE_REDIRECT_URI = _env('GOOGLE_REDIRECT_URI', '')
+GOOGLE_ENCRYPTION_KEY = _env('GOOGLE_ENCRYPTION_KEY', '')
 GOOGLE_SCOPES = [
     'https://www.googleapis.com/auth/drive.file',
     'https://www.googleapis.com/auth/documents',
@@ -136,26 +180,26 @@ GOOGLE_OAUTH_CONFIGURED = bool(
     and GOOGLE_REDIRECT_URI
     and GOOGLE_ENCRYPTION_KEY
 )
-SHOW_GOOGLE_OAUTH_IN_MENU = os.getenv(
+SHOW_GOOGLE_OAUTH_IN_MENU = _bool(
     'SHOW_GOOGLE_OAUTH_IN_MENU',
     'false' if ENVIRONMENT in ('production', 'prod') else 'true',
-).lower() in ('1', 'true', 'yes')
+)
 
-AGENT_FIRST = os.getenv('AGENT_FIRST', 'false').lower() in ('1', 'true', 'yes')
+AGENT_FIRST = _bool('AGENT_FIRST', 'false')
 if FEATURE_GOOGLE_CALENDAR:
     GOOGLE_SCOPES.append('https://www.googleapis.com/auth/calendar.readonly')
     GOOGLE_SCOPES.append('https://www.googleapis.com/auth/calendar.events')
 
-MINIAPP_PUBLIC_URL = os.getenv('MINIAPP_PUBLIC_URL', 'https://cyberkitty.ru/miniapp').rstrip("/")
+MINIAPP_PUBLIC_URL = _env('MINIAPP_PUBLIC_URL', 'https://cyberkitty.ru/miniapp').rstrip("/")
 # Dev override for MiniApp URL (typically a HTTPS tunnel such as cloudflared/ngrok).
 # If set, the bot will use this URL for MiniApp buttons.
-MINIAPP_DEV_TUNNEL_URL = os.getenv('MINIAPP_DEV_TUNNEL_URL', '').strip().rstrip("/")
+MINIAPP_DEV_TUNNEL_URL = _env('MINIAPP_DEV_TUNNEL_URL', '').strip().rstrip("/")
 # Effective URL used by bot UI.
 MINIAPP_EFFECTIVE_URL = (MINIAPP_DEV_TUNNEL_URL or MINIAPP_PUBLIC_URL).rstrip("/")
-MINIAPP_PROXY_URL = os.getenv('MINIAPP_PROXY_URL', 'https://t.me/CyberKitty19_bot/journal').rstrip('/')
-MINIAPP_PROXY_QUERY_PARAM = os.getenv('MINIAPP_PROXY_QUERY_PARAM', 'startapp').strip() or 'startapp'
-MINIAPP_NOTE_LINK_TEMPLATE = os.getenv('MINIAPP_NOTE_LINK_TEMPLATE', '').strip()
-TELEGRAM_REFERRAL_URL = os.getenv('TELEGRAM_REFERRAL_URL', 'https://t.me/CyberKitty19_bot/journal').rstrip('/')
+MINIAPP_PROXY_URL = _env('MINIAPP_PROXY_URL', 'https://t.me/CyberKitty19_bot/journal').rstrip('/')
+MINIAPP_PROXY_QUERY_PARAM = _env('MINIAPP_PROXY_QUERY_PARAM', 'startapp').strip() or 'startapp'
+MINIAPP_NOTE_LINK_TEMPLATE = _env('MINIAPP_NOTE_LINK_TEMPLATE', '').strip()
+TELEGRAM_REFERRAL_URL = _env('TELEGRAM_REFERRAL_URL', 'https://t.me/CyberKitty19_bot/journal').rstrip('/')
 
 logger.info("✅ Конфигурация загружена успешно")
 logger.info(f"🏠 Режим: {'контейнер' if IN_CONTAINER else 'локальный'}")
@@ -170,7 +214,7 @@ logger.info(f"🧭 Router модель: {ROUTER_MODEL}")
 logger.info(f"📂 Google Drive интеграция включена: {GOOGLE_OAUTH_CONFIGURED}")
 
 # Управление пользовательскими уведомлениями об ошибках
-SUPPRESS_FAILURE_MESSAGES = os.getenv('SUPPRESS_FAILURE_MESSAGES', 'true').lower() in ('1', 'true', 'yes')
+SUPPRESS_FAILURE_MESSAGES = _bool('SUPPRESS_FAILURE_MESSAGES', 'true')
 if SUPPRESS_FAILURE_MESSAGES:
     logger.info("🔇 Пользовательские сообщения об ошибках обработки медиa отключены (SUPPRESS_FAILURE_MESSAGES=true)")
 
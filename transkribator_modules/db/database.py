@@ -6,8 +6,9 @@ import os
 import hashlib
 import secrets
 import json
+import functools
 from datetime import datetime, timedelta, time
-from typing import Optional, List
+from typing import Iterable, Optional, List
 from sqlalchemy import create_engine, desc, func, inspect
 from sqlalchemy.orm import sessionmaker, Session, joinedload
 from sqlalchemy.exc import IntegrityError
@@ -453,17 +454,24 @@ def get_db():
     finally:
         db.close()
 
+# Пространство ключей advisory-блокировок для изменения плана пользователя
+_USER_PLAN_LOCK_NS = 0x706C616E  # "plan"
+
+
 class UserService:
     def __init__(self, db: Session):
         self.db = db
 
-    def _commit_user_safely(self, user: "User") -> None:
+    def _commit_user_safely(self, user: "User", *, commit: bool = True) -> None:
         """Commit user changes, tolerating rare duplicate-row anomalies.
 
         If legacy data or a partial restore introduces duplicate rows for the same
         identity, SQLAlchemy can raise an error like:
         "UPDATE statement on table 'users' expected to update 1 row(s); 2 were matched."
         This helper retries after reloading a canonical row.
+
+        With ``commit=False`` the same targeted UPDATE is executed inside the
+        caller's transaction (a new row is only flushed) and nothing is committed.
         """
         # Instead of relying on ORM flush rowcount checks (which are currently
         # triggering "expected to update 1 row(s); 2 were matched" even though
@@ -471,10 +479,12 @@ class UserService:
         # This avoids the ORM's assertion-style rowcount validation.
         from sqlalchemy import update  # local import to avoid circulars
 
+        finish = self.db.commit if commit else self.db.flush
+
         user_id = getattr(user, "id", None)
         if not user_id:
             # No PK yet (new row) -> normal commit
-            self.db.commit()
+            finish()
             return
 
         values = {}
@@ -488,7 +498,7 @@ class UserService:
                 values[key] = value
 
         if not values:
-            self.db.commit()
+            finish()
             return
 
         try:
@@ -522,9 +532,15 @@ class UserService:
                 except Exception:
                     pass
 
-            self.db.execute(stmt)
+            # Без autoflush: иначе ORM успеет записать грязный объект своим UPDATE
+            self.db.execute(stmt, execution_options={"autoflush": False})
+            if not commit:
+                # Откат и диагностику выполняет владелец транзакции
+                return
             self.db.commit()
         except Exception:
+            if not commit:
+                raise
             self.db.rollback()
             # Diagnostic: inspect rows that match the PK and the telegram_id to help
             # understand "expected to update 1 row(s); 2 were matched" anomalies.
@@ -562,9 +578,19 @@ class UserService:
         """Получить пользователя по id."""
         return self.db.query(User).filter(User.id == user_id).first()
 
+    def get_user_by_telegram_id(self, telegram_id: int) -> Optional[User]:
+        """Получить пользователя по telegram_id без побочных записей."""
+        return self.db.query(User).filter(User.telegram_id == telegram_id).first()
+
     def get_or_create_user(self, telegram_id: int, username: str = None,
-                          first_name: str = None, last_name: str = None) -> User:
-        """Получить или создать пользователя"""
+                          first_name: str = None, last_name: str = None,
+                          *, commit: bool = True) -> User:
+        """Получить или создать пользователя.
+
+        При ``commit=False`` изменения записываются в текущую транзакцию тем же
+        целевым UPDATE, а фиксацию выполняет вызывающий код вместе с остальными записями.
+        """
+        persist = functools.partial(self._commit_user_safely, commit=commit)
         user = self.db.query(User).filter(User.telegram_id == telegram_id).first()
 
         if not user:
@@ -578,8 +604,9 @@ class UserService:
                 beta_enabled=True,
             )
             self.db.add(user)
-            self._commit_user_safely(user)
-            self.db.refresh(user)
+            persist(user)
+            if commit:
+                self.db.refresh(user)
             setattr(user, "_was_created", True)
         else:
             # Обновляем информацию пользователя
@@ -590,26 +617,26 @@ class UserService:
             if last_name:
                 user.last_name = last_name
             user.updated_at = datetime.utcnow()
-            self._commit_user_safely(user)
+            persist(user)
             setattr(user, "_was_created", False)
 
         if getattr(user, "beta_enabled", None) is None and user.current_plan in AGENT_ELIGIBLE_PLANS:
             user.beta_enabled = True
             user.updated_at = datetime.utcnow()
-            self._commit_user_safely(user)
+            persist(user)
 
         # Обнуляем beta_enabled, если пришёл старый null
         if getattr(user, "beta_enabled", None) is None:
             user.beta_enabled = False
-            self._commit_user_safely(user)
+            persist(user)
 
         if getattr(user, "google_connected", None) is None:
             user.google_connected = False
-            self._commit_user_safely(user)
+            persist(user)
 
         if getattr(user, "timezone", None) == "":
             user.timezone = None
-            self._commit_user_safely(user)
+            persist(user)
 
         return user
 
@@ -785,10 +812,44 @@ class UserService:
 
         return info
 
-    def upgrade_user_plan(self, user: User, new_plan: str, transaction_id: int = None) -> bool:
-        """Обновить план пользователя"""
-        plan = self.db.query(Plan).filter(Plan.name == new_plan).first()
-        if not plan:
+    def lock_user_plan(self, telegram_id: int) -> None:
+        """Сериализует изменение плана пользователя до конца текущей транзакции.
+
+        На PostgreSQL берёт ``pg_advisory_xact_lock`` по telegram_id: параллельные
+        оплаты одного пользователя (Stars и webhook ЮКассы) применяются по очереди
+        и не затирают друг другу ``plan_expires_at``. Блокировка снимается при
+        COMMIT/ROLLBACK. На других бэкендах ничего не делает.
+
+        Вызывать в короткой транзакции, которая только применяет платеж: пока
+        она открыта, остальные оплаты этого пользователя ждут. Несколько
+        пользователей в одной транзакции блокируются через ``lock_user_plans``.
+        """
+        self.lock_user_plans((telegram_id,))
+
+    def lock_user_plans(self, telegram_ids: Iterable[int]) -> None:
+        """Берёт блокировки ``lock_user_plan`` сразу для нескольких пользователей.
+
+        Ключи берутся по возрастанию: транзакции с пересекающимися наборами
+        пользователей ждут друг друга, но не попадают во взаимную блокировку.
+        """
+        if self.db.get_bind().dialect.name != "postgresql":
+            return
+        for key in sorted({int(telegram_id) & 0x7FFFFFFF for telegram_id in telegram_ids}):
+            self.db.execute(
+                text("SELECT pg_advisory_xact_lock(:ns, :uid)"),
+                {"ns": _USER_PLAN_LOCK_NS, "uid": key},
+            )
+
+    def upgrade_user_plan(self, user: User, new_plan: str, transaction_id: int = None,
+                          *, commit: bool = True) -> bool:
+        """Обновить план пользователя.
+
+        С ``commit=False`` изменения пишутся целевым UPDATE в текущую транзакцию,
+        фиксирует их вызывающий код.
+        """
+        # Нужна только проверка существования тарифа — не загружаем строку Plan целиком
+        plan_exists = self.db.query(Plan.id).filter(Plan.name == new_plan).first()
+        if not plan_exists:
             return False
 
         user.current_plan = new_plan
@@ -813,7 +874,7 @@ class UserService:
             # Для бесплатного тарифа отсчитываем генерации заново в текущем месяце
             user.generations_used_this_month = min(user.generations_used_this_month, 3)
 
-        self._commit_user_safely(user)
+        self._commit_user_safely(user, commit=commit)
         return True
 
     def _reset_monthly_usage_if_needed(self, user: User) -> bool:
@@ -1285,8 +1346,13 @@ class TransactionService:
                           provider_payment_charge_id: str = None,
                           telegram_payment_charge_id: str = None,
                           external_payment_id: str = None,
-                          status: str = "completed") -> Transaction:
-        """Создать новую транзакцию"""
+                          status: str = "completed",
+                          *, commit: bool = True) -> Transaction:
+        """Создать новую транзакцию.
+
+        С ``commit=False`` строка только сбрасывается в сессию (flush), чтобы
+        вызывающий код мог зафиксировать её вместе с другими изменениями.
+        """
         transaction = Transaction(
             user_id=user.id,
             plan_type=plan_type,
@@ -1302,13 +1368,16 @@ class TransactionService:
         )
 
         self.db.add(transaction)
-        self.db.commit()
-        self.db.refresh(transaction)
+        if commit:
+            self.db.commit()
+            self.db.refresh(transaction)
+        else:
+            self.db.flush()
 
         if status == "completed" and amount_rub:
             try:
                 referral_service = ReferralService(self.db)
-                referral_service.record_referral_payment(user, amount_rub, commit=True)
+                referral_service.record_referral_payment(user, amount_rub, commit=commit)
             except Exception as exc:  # noqa: BLE001
                 logger.warning(
                     "Failed to record referral payment",
@@ -1328,6 +1397,22 @@ class TransactionService:
             Transaction.user_id == user.id
         ).order_by(desc(Transaction.created_at)).limit(limit).all()
 
+    def exists_by_telegram_charge_id(self, charge_id: str | None) -> bool:
+        """Проверить, сохранён ли уже платеж Telegram с таким charge id"""
+        if not charge_id:
+            return False
+        return self.db.query(Transaction.id).filter(
+            Transaction.telegram_payment_charge_id == charge_id
+        ).first() is not None
+
+    def exists_by_external_id(self, payment_id: str | None) -> bool:
+        """Проверить, сохранён ли уже платеж внешнего провайдера (ЮKassa)"""
+        if not payment_id:
+            return False
+        return self.db.query(Transaction.id).filter(
+            Transaction.external_payment_id == payment_id
+        ).first() is not None
+
     def get_transaction_by_payment_id(self, payment_id: str) -> Optional[Transaction]:
         """Найти транзакцию по ID платежа"""
         return self.db.query(Transaction).filter(
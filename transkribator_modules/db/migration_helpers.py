@@ -0,0 +1,57 @@
+"""Общие проверки для миграций Alembic, добавляющих уникальные индексы."""
+
+from __future__ import annotations
+
+from typing import Optional
+
+import sqlalchemy as sa
+
+MAX_LISTED_DUPLICATES = 20
+
+
+def find_index(inspector, table: str, index_name: str) -> Optional[dict]:
+    """Вернуть описание индекса по имени или None, если его нет."""
+    for index in inspector.get_indexes(table):
+        if index["name"] == index_name:
+            return index
+    return None
+
+
+def fail_on_duplicates(bind, table: str, column: str, index_name: str) -> None:
+    """Остановить миграцию, если в колонке есть повторяющиеся непустые значения.
+
+    Строки не удаляются и не изменяются автоматически: в ``transactions`` это
+    записи о платежах, и решение по каждому дубликату принимает оператор.
+    """
+    rows = bind.execute(
+        sa.text(
+            f"""
+            SELECT {column}, COUNT(*) AS cnt, MIN(id) AS first_id, MAX(id) AS last_id
+            FROM {table}
+            WHERE {column} IS NOT NULL
+            GROUP BY {column}
+            HAVING COUNT(*) > 1
+            ORDER BY MIN(id)
+            """
+        )
+    ).fetchall()
+    if not rows:
+        return
+    listed = "\n".join(
+        f"  {column}={row[0]!r}: {row[1]} строк (id {row[2]}..{row[3]})"
+        for row in rows[:MAX_LISTED_DUPLICATES]
+    )
+    more = len(rows) - MAX_LISTED_DUPLICATES
+    if more > 0:
+        listed += f"\n  ... и ещё {more}"
+    raise RuntimeError(
+        f"Нельзя создать уникальный индекс {index_name}: в {table}.{column} "
+        f"есть повторяющиеся значения ({len(rows)} шт.):\n{listed}\n"
+        f"Для каждого значения оставьте одну строку: удалите лишние записи или обнулите "
+        f"у них {column} (UPDATE {table} SET {column} = NULL WHERE id IN (...)), "
+        "предварительно сверив платежи и тарифы пользователей. "
+        "Затем повторите `alembic upgrade head`."
+    )
+
+
+__all__ = ["MAX_LISTED_DUPLICATES", "fail_on_duplicates", "find_index"]
@@ -162,11 +162,11 @@ class Transaction(Base):
 
     # Идентификаторы платежей
     provider_payment_charge_id = Column(String, nullable=True)
-    telegram_payment_charge_id = Column(String, nullable=True)
-    external_payment_id = Column(String, nullable=True)
+    telegram_payment_charge_id = Column(String, nullable=True, unique=True, index=True)
+    external_payment_id = Column(String, nullable=True, unique=True, index=True)
 
     # Статус оплаты
-    status = Column(String, default="pending")  # pending, completed, failed, refunded
+    status = Column(String, default="pending")  # pending, completed, failed, refunded, upgrade_failed
     payment_method = Column(String, nullable=True)  # telegram_stars, stripe, yookassa, etc.
 
     # Временные метки
@@ -6,6 +6,8 @@ from __future__ import annotations
 
 import json
 import math
+import time
+from collections import deque
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from typing import Iterable, List, Optional
@@ -31,6 +33,13 @@ EXPIRED_KIND = "plan_expired_notification"
 PRE_EXPIRY_WINDOW = timedelta(days=3)
 EXPIRED_LOOKBACK = timedelta(days=3)
 
+# Telegram ограничивает рассылку ~30 сообщениями в секунду; держим запас
+SEND_RATE_PER_SECOND = 28
+RETRY_AFTER_MAX_ATTEMPTS = 3
+# Рассылку вызывает цикл воркера перед взятием задач: суммарно ждём flood wait
+# не дольше этого, а неотправленные напоминания оставляем следующему запуску
+RATE_LIMIT_PAUSE_BUDGET = 5.0  # seconds
+
 
 @dataclass(frozen=True)
 class PlanNotification:
@@ -158,7 +167,69 @@ def _telegram_endpoint(method: str) -> str:
     return f"{base.rstrip('/')}/bot{BOT_TOKEN}/{method}"
 
 
-def _dispatch_notifications(notifications: Iterable[PlanNotification]) -> int:
+class _SendPacer:
+    """Sleep only when the per-second Telegram budget is exhausted."""
+
+    def __init__(self, rate: int = SEND_RATE_PER_SECOND, window: float = 1.0) -> None:
+        self.rate = rate
+        self.window = window
+        self.window_start = time.monotonic()
+        self.sent_in_window = 0
+        self.paused_until = 0.0
+
+    def pause(self, seconds: float) -> None:
+        """Hold every send for ``seconds``: Telegram's retry_after is bot-wide."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def wait(self) -> None:
+        now = time.monotonic()
+        if now < self.paused_until:
+            time.sleep(self.paused_until - now)
+            self.window_start = time.monotonic()
+            self.sent_in_window = 0
+        elif now - self.window_start >= self.window:
+            self.window_start = now
+            self.sent_in_window = 0
+        elif self.sent_in_window >= self.rate:
+            time.sleep(self.window_start + self.window - now)
+            self.window_start = time.monotonic()
+            self.sent_in_window = 0
+        self.sent_in_window += 1
+
+
+def _retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    """Return the flood wait of a 429 response, or None for any other status.
+
+    Telegram puts it in ``parameters.retry_after``; a proxy in front of a local
+    Bot API server may only send the ``Retry-After`` header.
+    """
+    if response.status_code != 429:
+        return None
+    try:
+        retry_after = response.json().get("parameters", {}).get("retry_after")
+    except Exception:  # noqa: BLE001 - fall back to the header
+        retry_after = None
+    if retry_after is None:
+        retry_after = response.headers.get("Retry-After")
+    try:
+        return float(retry_after or 1)
+    except (TypeError, ValueError):  # an HTTP-date or garbage: use a conservative pause
+        return 1.0
+
+
+def _dispatch_notifications(
+    notifications: Iterable[PlanNotification],
+    *,
+    wait_on_rate_limit: bool = True,
+) -> int:
+    """Send reminders through the Bot API, pacing under the Telegram limit.
+
+    A 429 pauses all sends, but the pauses of one run add up to at most
+    ``RATE_LIMIT_PAUSE_BUDGET``. A longer flood wait stops the run: reminders
+    left unsent have no event recorded, so ``_already_sent`` lets the next run
+    pick them up. With ``wait_on_rate_limit=False`` the budget is zero, for
+    callers running on the bot's event loop.
+    """
     sent = 0
     endpoint = _telegram_endpoint("sendMessage")
     notifications = list(notifications)
@@ -169,16 +240,39 @@ def _dispatch_notifications(notifications: Iterable[PlanNotification]) -> int:
         "Sending plan reminders",
         extra={"count": len(notifications)},
     )
+    # 429 retry_after is a flood wait for the whole bot, not for one chat:
+    # the pacer pauses all sends and the rejected reminder goes out first after it.
+    queue: deque[tuple[int, PlanNotification]] = deque((0, item) for item in notifications)
+    pacer = _SendPacer()
+    pause_budget = RATE_LIMIT_PAUSE_BUDGET if wait_on_rate_limit else 0.0
     with httpx.Client(timeout=10.0) as client:
-        for item in notifications:
+        while queue:
+            attempt, item = queue.popleft()
+            pacer.wait()
             payload = {
                 "chat_id": item.telegram_id,
                 "text": item.message,
-                "parse_mode": "Markdown",
                 "disable_web_page_preview": True,
             }
             try:
                 response = client.post(endpoint, json=payload)
+                retry_after = _retry_after_seconds(response)
+                if retry_after is not None:
+                    backoff = retry_after * (2 ** attempt)
+                    if attempt < RETRY_AFTER_MAX_ATTEMPTS and backoff <= pause_budget:
+                        logger.warning(
+                            "Telegram rate limit hit, pausing reminders",
+                            extra={"user_id": item.user_id, "kind": item.kind, "delay": backoff},
+                        )
+                        pause_budget -= backoff
+                        pacer.pause(backoff)
+                        queue.appendleft((attempt + 1, item))
+                        continue
+                    logger.warning(
+                        "Telegram rate limit hit, leaving reminders for the next run",
+                        extra={"remaining": len(queue) + 1, "retry_after": retry_after},
+                    )
+                    break
                 response.raise_for_status()
                 data = response.json()
                 if not data.get("ok"):
@@ -316,7 +410,9 @@ def send_expired_notification(user: User, plan_expires_at: datetime) -> bool:
     finally:
         session.close()
 
-    sent = _dispatch_notifications([notification])
+    # Вызывается синхронно из UserService.check_usage_limit внутри async-хендлеров
+    # бота: при 429 не спим на event loop, а сразу считаем отправку неудачной
+    sent = _dispatch_notifications([notification], wait_on_rate_limit=False)
     return sent > 0
 
 
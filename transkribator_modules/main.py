@@ -16,6 +16,7 @@ from transkribator_modules.config import (
     USE_LOCAL_BOT_API,
     LOCAL_BOT_API_URL,
     FEATURE_BETA_MODE,
+    BOT_HTTP_POOL_SIZE,
 )
 from transkribator_modules.bot.commands import (
     start_command,
@@ -88,7 +89,7 @@ def main() -> None:
     
     # Создаем HTTP request с увеличенными таймаутами для больших файлов
     request = HTTPXRequest(
-        connection_pool_size=8,
+        connection_pool_size=BOT_HTTP_POOL_SIZE,
         read_timeout=1800,  # 30 минут для чтения
         write_timeout=1800,  # 30 минут для записи
         connect_timeout=60,  # 1 минута для подключения
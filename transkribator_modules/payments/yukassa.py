@@ -154,8 +154,14 @@ class YukassaPaymentService:
         }
         return descriptions.get(plan_type, "Неизвестный план")
 
-    def process_webhook(self, webhook_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-        """Обрабатывает webhook от ЮKassa"""
+    def process_webhook(self, webhook_data: Dict[str, Any], *,
+                        allow_body_fallback: bool = False) -> Optional[Dict[str, Any]]:
+        """Обрабатывает webhook от ЮKassa.
+
+        Платеж подтверждается запросом к API ЮKassa. Данными из тела webhook можно
+        воспользоваться, только если источник уже проверен (``allow_body_fallback``):
+        иначе поддельный POST мог бы активировать тариф.
+        """
         try:
             if webhook_data.get('event') != 'payment.succeeded':
                 logger.info(f"Получен webhook с событием: {webhook_data.get('event')}")
@@ -172,6 +178,10 @@ class YukassaPaymentService:
                 logger.info(f"Платеж {payment_id} успешно подтвержден через verify_payment")
                 return payment_info
 
+            if not allow_body_fallback:
+                logger.warning(f"Платеж {payment_id} не подтверждён через API ЮKassa")
+                return None
+
             # Fallback: используем тело вебхука, если оно содержит все данные.
             status = payment_data.get('status')
             metadata = payment_data.get('metadata') or {}
@@ -193,3 +203,18 @@ class YukassaPaymentService:
         except Exception as e:
             logger.error(f"Ошибка обработки webhook ЮKassa: {e}")
             return None
+
+
+_yukassa_service: Optional[YukassaPaymentService] = None
+
+
+def get_yukassa_service() -> YukassaPaymentService:
+    """Возвращает общий экземпляр сервиса ЮKassa, создавая его при первом вызове.
+
+    Если ЮKassa не настроена, конструктор бросает ValueError и экземпляр не
+    кешируется — следующий вызов повторит попытку.
+    """
+    global _yukassa_service
+    if _yukassa_service is None:
+        _yukassa_service = YukassaPaymentService()
+    return _yukassa_service